@@ -1,6 +1,7 @@
 import numpy as np
-from .parameter_object import Parameter, Parameter_Array
+from .parameter_object import Parameter, Parameter_Array, Parameter_Vector
 from autoprof.utils.conversions.coordinates import coord_to_index, index_to_coord
+from autoprof.utils.interpolate import cubic_spline_coefficients
 from autoprof.image import Model_Image, AP_Window
 from copy import deepcopy
 
@@ -12,8 +13,20 @@ def _set_default_parameters(self):
     self.is_sampled = False
     self.is_convolved = False
     self.is_integrated = False
+    self.is_shifted = False
+    self.is_scaled = False
+    self._rendered_amplitude = None
+    self._rendered_center = None
+    self._shift_reference = None
+    self._psf_applied = False
+    # Largest absolute flux on the window edge of the last convolved image, see can_shift_center
+    self._edge_flux = None
+    self._render_versions = {}
     self.model_integrate = None
     self.integrate_window = None
+    self._spline_cache = {}
+    self._geometry_cache = {}
+    self.noise_level = None
 
 def set_target(self, target):
     self.target = target
@@ -22,8 +35,8 @@ def set_window(self, window = None, index_units = True):
     # If no window given, use the whole image
     if window is None:
         window = [
-            [0, self.target.shape[0]],
             [0, self.target.shape[1]],
+            [0, self.target.shape[0]],
         ]
         index_units = False
 
@@ -42,6 +55,11 @@ def set_window(self, window = None, index_units = True):
         )
     if self._base_window is None:
         self._base_window = self.window
+
+    # A new model image must be rendered from scratch
+    self._geometry_cache = {}
+    for stage in self.render_stages:
+        setattr(self, self.render_stages[stage], False)
         
     # Create the model image for this model
     self.model_image = Model_Image(
@@ -53,6 +71,21 @@ def set_window(self, window = None, index_units = True):
 def scale_window(self, scale):
     self.set_window(self._base_window.scaled_window(scale, limit_window = self.target.window))
 
+def center_window(self, radius):
+    """
+    Set the window to a box reaching radius (arcsec) from the model center in each direction,
+    snapped to the target pixels and limited to the target.
+    """
+    center = np.array((self["center"][1].value, self["center"][0].value))
+    pixelscale = self.target.pixelscale
+    low = np.floor((center - radius - self.target.origin) / pixelscale) * pixelscale + self.target.origin
+    high = np.ceil((center + radius - self.target.origin) / pixelscale) * pixelscale + self.target.origin
+    low = np.maximum(low, self.target.window.origin)
+    high = np.minimum(high, self.target.window.origin + self.target.window.shape)
+    self.set_window(AP_Window(low, high - low))
+    # Expanded windows are now scaled from the fitted size
+    self._base_window = self.window
+
 def update_locked(self, locked):
     if isinstance(locked, bool):
         self.locked = bool(self.user_locked) or locked
@@ -97,11 +130,17 @@ def build_parameter_qualities(cls):
     return parameter_qualities
 
 def build_parameters(self):
+    # All the model parameters are stored in one vector
+    self.parameter_vector = Parameter_Vector()
     for p in self.parameter_specs:
         if isinstance(self.parameter_specs[p], dict):
-            self.parameters[p] = Parameter(p, **self.parameter_specs[p])
+            if self.parameter_qualities.get(p, {}).get("form", "value") == "array":
+                self.parameters[p] = Parameter_Array(p, vector = self.parameter_vector, **self.parameter_specs[p])
+            else:
+                self.parameters[p] = Parameter(p, vector = self.parameter_vector, **self.parameter_specs[p])
         elif isinstance(self.parameter_specs[p], Parameter):
             self.parameters[p] = self.parameter_specs[p]
+            self.parameters[p].move_to(self.parameter_vector)
         else:
             raise ValueError(f"unrecognized parameter specification for {p}")
 
@@ -115,9 +154,95 @@ def step_iteration(self):
         self.history.add_step(self.parameters, self.loss)
         self.loss = None
     self.iteration += 1
-    self.is_sampled = False
-    self.is_convolved = False
-    self.is_integrated = False
+
+def check_updates(self):
+    """
+    Compare the parameter versions to those used for the last render. The earliest render stage
+    which depends on a changed parameter, and every stage after it, is flagged to be run again.
+    Returns True if any stage needs to be re-run.
+    """
+    versions = dict((p, self.parameters[p].version) for p in self.parameters)
+    stages = list(self.render_stages.keys())
+    first = len(stages)
+    for p in versions:
+        if versions[p] == self._render_versions.get(p, None):
+            continue
+        param_stages = self.parameter_qualities[p].get("stages", stages)
+        # An image rendered with zero amplitude can't be rescaled, so it is rendered again
+        if p == self.amplitude_parameter and not self._rendered_amplitude:
+            param_stages = stages
+        # Large center moves need a full render rather than a shift
+        if p == "center" and not self.can_shift_center():
+            param_stages = stages
+        for stage in param_stages:
+            first = min(first, stages.index(stage))
+    self._render_versions = versions
+    
+    for stage in stages[first:]:
+        setattr(self, self.render_stages[stage], False)
+    return first < len(stages)
+
+def profile_spline(self, key, knots, values):
+    """
+    Return cubic spline coefficients for a profile, only rebuilding them if the knots or values
+    have changed since the last time this profile was requested.
+    """
+    if key in self._spline_cache:
+        cache_knots, cache_values, coefs = self._spline_cache[key]
+        if np.array_equal(cache_knots, knots) and np.array_equal(cache_values, values):
+            return coefs
+    coefs = cubic_spline_coefficients(knots, values)
+    self._spline_cache[key] = (np.copy(knots), np.copy(values), coefs)
+    return coefs
+
+def geometry_map(self, key, image, parameters, build, lazy = False, tolerance = None):
+    """
+    Return a map over the pixels of image (such as the transformed radius of each pixel) which
+    depends only on the given parameters, only calling build to recompute it when one of those
+    parameters has changed since the map was made. With lazy, a map is only built the second time
+    the same parameter values are requested and None is returned otherwise, so that maps which
+    would never be reused are not stored. With tolerance (one absolute tolerance per parameter),
+    the map is kept until a parameter value moves further than its tolerance from the value the
+    map was built with, for maps which are insensitive to small parameter changes.
+    """
+    image_key = (key, image.data.shape, tuple(image.origin), image.pixelscale)
+    if tolerance is None:
+        versions = tuple(self[p].version for p in parameters)
+    else:
+        versions = self._parameter_values(parameters)
+    cache_versions, cache_map = self._geometry_cache.get(image_key, (None, None))
+    if tolerance is not None and cache_versions is not None and cache_map is not None:
+        if np.all(self._parameter_distance(parameters, versions, cache_versions) <= np.repeat(tolerance, list(len(v) for v in versions))):
+            return cache_map
+    elif cache_versions == versions and cache_map is not None:
+        return cache_map
+    if lazy and tolerance is None and cache_versions != versions:
+        # First request with these parameter values, remember them but don't build the map yet
+        self._geometry_cache[image_key] = (versions, None)
+        return None
+    cache_map = build()
+    self._geometry_cache[image_key] = (versions, cache_map)
+    return cache_map
+
+def _parameter_values(self, parameters):
+    return tuple(np.atleast_1d(self[p].get_values() if isinstance(self[p], Parameter_Array) else self[p].value).copy() for p in parameters)
+
+def _parameter_distance(self, parameters, values1, values2):
+    """
+    Absolute difference between two sets of parameter values, taking the shortest way around for
+    cyclic parameters. Arrays which changed length are infinitely far apart.
+    """
+    distance = []
+    for p, v1, v2 in zip(parameters, values1, values2):
+        if len(v1) != len(v2):
+            distance.append(np.full(len(v1), np.inf))
+            continue
+        d = np.abs(v1 - v2)
+        if self[p].cyclic:
+            period = self[p].limits[1] - self[p].limits[0]
+            d = np.minimum(d % period, period - (d % period))
+        distance.append(d)
+    return np.concatenate(distance)
 
 def save_model(self, fileobject):
     fileobject.write("\n" + "\n" + "*"*70 + "\n")
@@ -130,15 +255,11 @@ def __getitem__(self, key):
 
     # Try to access the parameter by name
     if key in self.parameters:
-        return P[key]
+        return self.parameters[key]
 
-    # Check any parameter arrays for the key
-    for subpar in self.parameters.values():
-        if not isinstance(subpar, Parameter_Array):
-            continue
-        try:
-            return subpar[key]
-        except KeyError:
-            pass
+    # Parameter array elements are named "array:index"
+    if key in self.parameter_vector:
+        array, index = key.rsplit(":", 1)
+        return self.parameters[array][int(index)]
         
     raise KeyError(f"{key} not in {self.name}. {str(self)}")
@@ -10,9 +10,11 @@ class FlatSky(Sky_Model):
         "noise": {"units": "flux/arcsec^2", "limits": (0,None)},
     }
     parameter_qualities = {
-        "sky": {"form": "value", "loss": "global"},
-        "noise": {"form": "value", "loss": "global"},
+        "sky": {"form": "value", "loss": "global", "stages": ("amplitude",)},
+        "noise": {"form": "value", "loss": "global", "stages": ()},
     }
+    amplitude_parameter = "sky"
+    constant_offset = True
 
     def _init_convert_input_units(self):
         super()._init_convert_input_units()
@@ -55,3 +57,16 @@ class FlatSky(Sky_Model):
             sample_image = self.model_image
         
         sample_image += self["sky"].value * sample_image.pixelscale**2
+
+    def derivative_images(self, sample_image, names):
+        derivatives = {}
+        if "sky" in names:
+            derivatives["sky"] = sample_image.blank_copy()
+            derivatives["sky"] += sample_image.pixelscale**2
+        return derivatives
+
+    def model_offset(self):
+        """
+        Flux per target pixel which this model adds over its window.
+        """
+        return self["sky"].value * self.target.pixelscale**2
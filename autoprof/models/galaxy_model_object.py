@@ -3,6 +3,8 @@ import numpy as np
 from autoprof.utils.initialize import isophotes
 from autoprof.utils.angle_operations import Angle_Average
 from autoprof.utils.conversions.coordinates import Rotate_Cartesian, Axis_Ratio_Cartesian, coord_to_index, index_to_coord
+from autoprof.utils.interpolate import adaptive_profile_table, profile_table_evaluate
+from autoprof.utils.sampling import symmetric_sample, coarse_sample
 from scipy.stats import iqr
 
 class Galaxy_Model(BaseModel):
@@ -16,6 +18,26 @@ class Galaxy_Model(BaseModel):
         "q": {"form": "value", "loss": "global"},
         "PA": {"form": "value", "loss": "global"},
     }
+    # Parameters which set the transformed radius of each pixel, while these are unchanged the
+    # radius map is reused and only the profile is evaluated
+    geometry_parameters = ("center", "q", "PA")
+    # Render the radial profile through a lookup table instead of evaluating it at every pixel
+    profile_lookup = True
+    profile_lookup_tolerance = 1e-4
+    profile_lookup_pixels = 10000
+    # When the center is aligned with the pixel grid, evaluate only half of the pixels and copy
+    # the rest using the point symmetry of the model
+    symmetric_sampling = True
+    symmetric_pixels = 10000
+    # Evaluate large images on a coarse grid and refine only where interpolation misses by more
+    # than coarse_tolerance times the pixel noise level, such as near the galaxy core
+    coarse_sampling = True
+    coarse_step = 8
+    coarse_tolerance = 0.1
+    coarse_pixels = 250000
+    # Pixel to radial bin maps for the loss are rebuilt once the geometry could move a pixel by
+    # more than this many pixels
+    radial_bin_tolerance = 0.1
 
     def _init_convert_input_units(self):
         super()._init_convert_input_units()
@@ -28,13 +50,15 @@ class Galaxy_Model(BaseModel):
             target = self.target
             
         super().initialize(target)
-        if not (self["PA"].value is None or self["q"].value is None):
-            return
-        print(self.name)
         target_area = target[self.window]
         edge = np.concatenate((target_area.data[:,0], target_area.data[:,-1], target_area.data[0,:], target_area.data[-1,:]))
         edge_average = np.median(edge)
         edge_scatter = iqr(edge, rng = (16,84))/2
+        # Per pixel noise at the target pixelscale, used to set the coarse sampling tolerance
+        self.noise_level = edge_scatter / target.pixelscale**2
+        if not (self["PA"].value is None or self["q"].value is None):
+            return
+        print(self.name)
         icenter = coord_to_index(self["center"][0].value, self["center"][1].value, target_area)
         if self["PA"].value is None:
             iso_info = isophotes(
@@ -59,6 +83,138 @@ class Galaxy_Model(BaseModel):
 
     def transform_coordinates(self, X, Y):
         return Axis_Ratio_Cartesian(self["q"].value, X, Y, self["PA"].value)
+
+    def pixel_radius(self, I, J, sample_image):
+        """
+        Radius metric at the centers of the pixels with array indices I, J in the sample image.
+        """
+        X, Y = index_to_coord(I + 0.5, J + 0.5, sample_image)
+        X, Y = self.transform_coordinates(X - self["center"][0].value, Y - self["center"][1].value)
+        return self.radius_metric(X, Y)
+
+    def sample_pixels(self, I, J, image, proxy = False):
+        if not proxy and (self.psf_mode != "none" or self.sample_mode != "direct"):
+            return None
+        return self.radial_model(self.pixel_radius(I, J, image), image)
+
+    def radial_derivatives(self, R, sample_image, names):
+        """
+        Derivative of radial_model with respect to R, and a dictionary with its derivatives with
+        respect to each of the named profile parameters. Returns None if the profile has no
+        analytic derivatives.
+        """
+        return None
+
+    def _derivative_geometry(self, sample_image):
+        """
+        Pixel coordinates relative to the center, their transformed values and the radius metric.
+        """
+        I = np.arange(sample_image.data.shape[0]).reshape(-1, 1)
+        J = np.arange(sample_image.data.shape[1]).reshape(1, -1)
+        X, Y = index_to_coord(I + 0.5, J + 0.5, sample_image)
+        X, Y = np.broadcast_arrays(X - self["center"][0].value, Y - self["center"][1].value)
+        TX, TY = self.transform_coordinates(X, Y)
+        return X, Y, TX, TY, self.radius_metric(TX, TY)
+
+    def derivative_images(self, sample_image, names):
+        # The coordinate maps are shared by every derivative image and kept while the geometry is unchanged
+        X, Y, TX, TY, R = self.geometry_map("derivatives", sample_image, self.geometry_parameters, lambda: self._derivative_geometry(sample_image))
+        radial = self.radial_derivatives(R, sample_image, names)
+        if radial is None:
+            return {}
+        slope, derivatives = radial
+
+        # Geometry parameters act through the radius, dR/dp = (TX dTX/dp + TY dTY/dp) / R
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            slope = np.where(R > 0, slope / R, 0.)
+        q, PA = self["q"].value, self["PA"].value
+        scale = 1 / q - 1
+        ss, cc = np.sin(PA)**2, np.cos(PA)**2
+        s2, c2 = np.sin(2 * PA), np.cos(2 * PA)
+        transform_derivatives = {
+            "center:0": lambda: (-(1 + scale * ss), scale * s2 / 2),
+            "center:1": lambda: (scale * s2 / 2, -(1 + scale * cc)),
+            "q": lambda: (-(ss * X - s2 * Y / 2) / q**2, -(cc * Y - s2 * X / 2) / q**2),
+            "PA": lambda: (scale * (s2 * X - c2 * Y), -scale * (c2 * X + s2 * Y)),
+        }
+        for name in names:
+            if name in transform_derivatives:
+                dTX, dTY = transform_derivatives[name]()
+                derivatives[name] = slope * (TX * dTX + TY * dTY)
+
+        images = {}
+        for name in derivatives:
+            images[name] = sample_image.blank_copy()
+            images[name] += derivatives[name]
+        return images
+
+    def window_radius(self, level):
+        # Radius is along the major axis, so the window box encloses the whole isophote
+        R = np.geomspace(self.target.pixelscale, np.sqrt(np.sum(self.target.shape**2)), 512)
+        flux = self.radial_model(R, self.target)
+        above = np.nonzero(flux >= level)[0]
+        if len(above) == 0:
+            return R[0]
+        return R[min(above[-1] + 1, len(R) - 1)]
+
+    def _geometry_tolerance(self, image, parameters):
+        """
+        Change in each geometry parameter which moves a pixel of image by radial_bin_tolerance
+        pixels, for the center directly and for the shape parameters at the image corner.
+        """
+        scale = self.radial_bin_tolerance * image.pixelscale
+        rmax = np.sqrt(np.sum(image.shape**2))
+        return tuple(scale if p == "center" else scale / rmax for p in parameters)
+
+    def _radial_bin_map(self, image, rad_bins):
+        """
+        Radial bin of each (loss subsampled) pixel in image, with an overflow bin for pixels
+        beyond the last edge, and the number of pixels in each bin.
+        """
+        X, Y = image.get_coordinate_meshgrid(self["center"][0].value, self["center"][1].value)
+        if self.loss_speed_factor != 1:
+            X = X[::self.loss_speed_factor,::self.loss_speed_factor]
+            Y = Y[::self.loss_speed_factor,::self.loss_speed_factor]
+        X, Y = self.transform_coordinates(X, Y)
+        index = np.clip(np.digitize(self.radius_metric(X, Y).ravel(), rad_bins) - 1, 0, len(rad_bins) - 1)
+        return index, np.bincount(index, minlength = len(rad_bins))
+
+    def radial_loss(self, loss_image, rad_bins):
+        """
+        Mean of the loss image in each radial bin, nan for empty bins. The bin of each pixel is
+        cached and only recomputed once the center or geometry has moved beyond
+        radial_bin_tolerance, so each call is a single pass over the pixels.
+        """
+        index, counts = self.geometry_map(
+            f"radial bins {self.loss_speed_factor} {len(rad_bins)}", loss_image, self.geometry_parameters,
+            lambda: self._radial_bin_map(loss_image, rad_bins),
+            tolerance = self._geometry_tolerance(loss_image, self.geometry_parameters),
+        )
+        data = loss_image.data[::self.loss_speed_factor,::self.loss_speed_factor]
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return (np.bincount(index, weights = data.ravel(), minlength = len(rad_bins)) / counts)[:-1]
+
+    def radial_profile(self, sample_image, rmax):
+        """
+        Return a function of radius which evaluates the radial model. For large images the
+        profile is tabulated on an adaptive grid of radii out to rmax and the table is
+        interpolated, rather than evaluating radial_model at every pixel. Any radii beyond rmax
+        are evaluated with radial_model directly.
+        """
+        if not self.profile_lookup or sample_image.data.size < self.profile_lookup_pixels:
+            return lambda R: self.radial_model(R, sample_image)
+        table = adaptive_profile_table(
+            lambda R: self.radial_model(R, sample_image),
+            0., rmax,
+            tolerance = self.profile_lookup_tolerance,
+        )
+        def profile(R):
+            values = profile_table_evaluate(table, R)
+            outside = R > rmax
+            if np.any(outside):
+                values[outside] = self.radial_model(R[outside], sample_image)
+            return values
+        return profile
         
     def sample_model(self, sample_image = None):
 
@@ -66,9 +222,34 @@ class Galaxy_Model(BaseModel):
             sample_image = self.model_image
 
         super().sample_model(sample_image)
-        
-        X, Y = sample_image.get_coordinate_meshgrid(self["center"][0].value, self["center"][1].value)
 
-        X, Y = self.transform_coordinates(X, Y)
-        
-        sample_image += self.radial_model(self.radius_metric(X, Y), sample_image)
+        I = np.arange(sample_image.data.shape[0]).reshape(-1, 1)
+        J = np.arange(sample_image.data.shape[1]).reshape(1, -1)
+
+        # The elliptical radius is a norm of the offset from the center, so it is largest at a
+        # corner. Radii past the corners (such as from warped coordinates) skip the lookup table
+        corners = self.pixel_radius(I[[0, 0, -1, -1], 0], J[0, [0, -1, 0, -1]], sample_image)
+        profile = self.radial_profile(sample_image, np.max(corners))
+
+        R = self.geometry_map("R", sample_image, self.geometry_parameters, lambda: self.pixel_radius(I, J, sample_image), lazy = True)
+        if R is not None:
+            # Only the profile changed since the last sample, reuse the radius map
+            sample_image += profile(R)
+        elif self.coarse_sampling and self.noise_level and sample_image.data.size >= self.coarse_pixels:
+            # Interpolate a coarse grid, refining tiles where the error is not well below the noise
+            sample_image += coarse_sample(
+                lambda I, J: profile(self.pixel_radius(I, J, sample_image)),
+                sample_image.data.shape,
+                self.coarse_step,
+                tolerance = self.coarse_tolerance * self.noise_level * sample_image.pixelscale**2,
+            )
+        elif self.symmetric_sampling and sample_image.data.size >= self.symmetric_pixels:
+            # Evaluate half the pixels and reflect them through the center
+            icenter = coord_to_index(self["center"][0].value, self["center"][1].value, sample_image)
+            sample_image += symmetric_sample(
+                lambda I, J: profile(self.pixel_radius(I, J, sample_image)),
+                sample_image.data.shape,
+                (icenter[0] - 0.5, icenter[1] - 0.5),
+            )
+        else:
+            sample_image += profile(self.pixel_radius(I, J, sample_image))
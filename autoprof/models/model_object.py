@@ -5,7 +5,7 @@ except:
 from autoprof.image import Model_Image, AP_Window
 from autoprof.utils.initialize import center_of_mass
 from autoprof.utils.conversions.coordinates import coord_to_index, index_to_coord
-from autoprof.utils.convolution import direct_convolve, fft_convolve
+from autoprof.utils.convolution import direct_convolve, fft_convolve, fft_shift
 from .parameter_object import Parameter, Optimize_History
 import numpy as np
 from copy import deepcopy
@@ -18,7 +18,7 @@ class BaseModel(object):
         "center": {"units": "arcsec", "uncertainty": 0.1},
     }
     parameter_qualities = {
-        "center": {"form": "array", "loss": "global"},
+        "center": {"form": "array", "loss": "global", "stages": ("shift",)},
     }
 
     # modes: direct, direct+PSF, integrate, integrate+PSF, integrate+superPSF
@@ -31,6 +31,31 @@ class BaseModel(object):
     integrate_window_size = 10
     integrate_factor = 5
     learning_rate = 0.1
+    # Optional function of the model iteration which returns the learning rate to use instead of
+    # learning_rate, for example to decay the step size as a fit converges
+    learning_rate_schedule = None
+    # Render stages in the order they are applied, and the flag which records that each is up to date.
+    # A parameter quality "stages" lists the stages which depend on it, by default all of them.
+    render_stages = {"sample": "is_sampled", "integrate": "is_integrated", "convolve": "is_convolved", "shift": "is_shifted", "amplitude": "is_scaled"}
+    # Parameter which the model image is directly proportional to, changing only this parameter
+    # rescales the rendered image in place instead of sampling it again
+    amplitude_parameter = None
+    # Models which are a constant over their window are applied as a scalar offset in the residual
+    # rather than rendered into an image, see model_offset
+    constant_offset = False
+    # Center changes up to this many pixels shift the PSF convolved image with a Fourier phase
+    # ramp instead of rendering it again, None to always render
+    shift_tolerance = 0.5
+    # Zero padding (pixels) around the image for Fourier shifts, so that flux shifted past one
+    # edge doesn't wrap around to the opposite edge of the window
+    shift_padding = 8
+    # Fourier shifts treat the image as zero beyond the window, so they are only used when every
+    # pixel on the window edge is below this fraction of the pixel noise level
+    shift_edge_tolerance = 0.1
+    # Number of recent optimization steps held in memory, and an optional filename where older
+    # steps are spilled so the full history is kept
+    history_depth = 64
+    history_memmap = None
     
     def __init__(self, name, target, window = None, locked = None, **kwargs):
 
@@ -45,7 +70,6 @@ class BaseModel(object):
         self.parameter_qualities = self.build_parameter_qualities()
         self.build_parameters()
         self._init_convert_input_units()
-        self.history = Optimize_History(self)
         
         # Set any user defined attributes for the model
         for kwarg in kwargs:
@@ -55,6 +79,7 @@ class BaseModel(object):
             # Set the model parameter
             print("setting: ", kwarg)
             setattr(self, kwarg, kwargs[kwarg])
+        self.history = Optimize_History(self, self.history_depth, self.history_memmap)
             
     def _init_convert_input_units(self):
         if self["center"].value is not None:
@@ -91,15 +116,99 @@ class BaseModel(object):
         
     # Fit loop functions
     ######################################################################        
-    def sample_model(self, target = None):
+    def sample_model(self, sample_image = None):
         if sample_image is None:
             sample_image = self.model_image
 
         if sample_image is self.model_image:
             self.is_sampled = True
+            if self.amplitude_parameter is not None:
+                self._rendered_amplitude = self[self.amplitude_parameter].value
+            self._rendered_center = np.array(self["center"].get_values())
+            self._shift_reference = None
+            self._psf_applied = False
             # Reset the model image before filling it with updated values
             self.model_image.clear_image()
 
+    def sample_pixels(self, I, J, image, proxy = False):
+        """
+        Model flux in the pixels with array indices I, J of image, evaluated without rendering
+        the model image. Returns None if the model image is not a pointwise function of pixel
+        position (for example when it is convolved with a PSF). With proxy, PSF convolution and
+        pixel integration are ignored, giving a cheap approximation of the rendered flux.
+        """
+        if self.constant_offset:
+            return np.full(np.shape(I), self.model_offset())
+        return None
+
+    def parameter_derivatives(self, names = None, psf = None):
+        """
+        Analytic derivatives of the model image with respect to the parameter vector elements in
+        names (by default all free elements), as a dictionary from element name to an image on
+        the model image grid. Derivatives are with respect to the parameter values, and elements
+        which the model can't differentiate are left out. PSF convolution is linear, so each
+        derivative image is convolved with the PSF in the same way as the model image. Pixel
+        integration is not included.
+        """
+        if names is None:
+            names = list(name for i, name in enumerate(self.parameter_vector.names) if not self.parameter_vector.fixed[i])
+        derivatives = self.derivative_images(self.model_image.blank_copy(), names)
+        if psf is not None and "none" not in self.psf_mode:
+            for name in derivatives:
+                self.convolve_image(derivatives[name], psf)
+        return derivatives
+
+    def derivative_images(self, sample_image, names):
+        """
+        Unconvolved derivative images of the model on the pixels of sample_image, for each of the
+        named parameter vector elements which the model has an analytic derivative for.
+        """
+        return {}
+
+    def jacobian(self, indices, step = 1e-3, psf = None):
+        """
+        Derivatives of the model image with respect to the representations of the parameter
+        vector elements at indices, as an array with one image for each element. Analytic
+        derivatives are used where the model has them, the other elements use central finite
+        differences with the given representation step, sampled into separate images so the
+        model image, render state and parameter versions are left untouched. With a psf, the
+        derivatives are convolved in the same way as the model image.
+        """
+        vector = self.parameter_vector
+        names = list(vector.names[i] for i in indices)
+        derivatives = self.parameter_derivatives(names, psf)
+        jacobian = np.zeros((len(indices),) + self.model_image.data.shape)
+        # Perturbed renders fill copies of the caches, so the versions can be restored afterwards
+        # without a cached map built from perturbed values matching them
+        caches = (self._geometry_cache, self._spline_cache)
+        self._geometry_cache, self._spline_cache = dict(caches[0]), dict(caches[1])
+        for k, (index, name) in enumerate(zip(indices, names)):
+            if name in derivatives:
+                jacobian[k] = derivatives[name].data * vector.values_derivative(index)[0]
+                continue
+            value = vector.get_values(index)
+            representation = vector.get_representation(index)
+            versions = np.copy(vector.versions[index])
+            for sign in (1, -1):
+                vector.set_representation(representation + sign * step, index)
+                sample_image = self.model_image.blank_copy()
+                self.sample_model(sample_image)
+                if psf is not None and "none" not in self.psf_mode:
+                    self.convolve_image(sample_image, psf)
+                jacobian[k] += sign * sample_image.data / (2 * step)
+            # Restore the value and its version, so the model isn't flagged to be rendered again
+            vector.set_values(value, index)
+            vector.versions[index] = versions
+        self._geometry_cache, self._spline_cache = caches
+        return jacobian
+
+    def window_radius(self, level):
+        """
+        Radius (arcsec) beyond which the model flux per target pixel stays below level, or None
+        if the model has no natural extent and should keep its window.
+        """
+        return None
+
     def integrate_model(self):
         if self.is_integrated:
             return
@@ -134,18 +243,8 @@ class BaseModel(object):
         if "none" in self.psf_mode or psf is None:
             return
 
-        # Convert the model center to image coordinates
-        psf_window = AP_Window(origin = (self["center"][1].value - self.psf_window_size*self.model_image.pixelscale/2, self["center"][0].value - self.psf_window_size*self.model_image.pixelscale/2),
-                               shape = (self.psf_window_size*self.model_image.pixelscale, self.psf_window_size*self.model_image.pixelscale))
-
         # Perform the PSF convolution using the specified method
-        psf_window_area = self.model_image[psf_window]
-        if "direct" in self.psf_mode:
-            psf_window_area.data = direct_convolve(psf_window_area.data, psf.data)    
-        elif "fft" in self.psf_mode:
-            psf_window_area.data = fft_convolve(psf_window_area.data, psf.data)
-        else:
-            raise ValueError(f"unrecognized psf_mode: {self.psf_mode}")
+        self.convolve_image(self.model_image, psf)
 
         if "integrate" in self.sample_mode:
             upsample_psf = psf.get_resolution(self.integrate_factor)
@@ -154,8 +253,33 @@ class BaseModel(object):
             elif 'fft' in self.psf_mode:
                 self.model_integrate.data = fft_convolve(self.model_integrate.data, upsample_psf.data)                
                 
-        # Keep record that the image has been convolved
+        # Keep record that the image has been convolved, and so is band limited by the PSF
         self.is_convolved = True
+        self._psf_applied = True
+        data = self.model_image.data
+        self._edge_flux = max(np.max(np.abs(data[[0, -1]])), np.max(np.abs(data[:, [0, -1]])))
+        
+    def convolve_image(self, image, psf):
+        """
+        Convolve an image on the model image grid with the PSF in place, over the region of
+        psf_window_size pixels around the model center which convolve_psf blurs. Images compared
+        against the rendered model (derivatives, trial renders) should be convolved with this.
+        """
+        # Convert the model center to image coordinates
+        psf_window = AP_Window(origin = (self["center"][1].value - self.psf_window_size*image.pixelscale/2, self["center"][0].value - self.psf_window_size*image.pixelscale/2),
+                               shape = (self.psf_window_size*image.pixelscale, self.psf_window_size*image.pixelscale))
+        psf_window_area = image[psf_window]
+        psf_window_area.data[:] = self.psf_convolve(psf_window_area.data, psf)
+
+    def psf_convolve(self, data, psf):
+        """
+        Convolve an array on the model image grid with the PSF, using the psf_mode method.
+        """
+        if "direct" in self.psf_mode:
+            return direct_convolve(data, psf.data)
+        elif "fft" in self.psf_mode:
+            return fft_convolve(data, psf.data)
+        raise ValueError(f"unrecognized psf_mode: {self.psf_mode}")
         
     def add_integrated_model(self):
         if not self.is_integrated:
@@ -164,26 +288,82 @@ class BaseModel(object):
         condensed = self.model_integrate.data.reshape(-1, integrate_factor, self.model_integrate.data.shape[0]//self.integrate_factor, self.integrate_factor).sum((-1,-3))
         self.model_image[self.integrate_window].data = condensed
         
+    def can_shift_center(self):
+        """
+        The rendered image can be shifted to the current center if it is band limited by the PSF,
+        has negligible flux on the window edge, the shift is small and no center dependent
+        integration window is in use.
+        """
+        if self.shift_tolerance is None or "none" in self.psf_mode or "integrate" in self.sample_mode:
+            return False
+        # A sharp unconvolved profile would ring, so the image must really have been convolved
+        if not self._psf_applied:
+            return False
+        if self._rendered_center is None:
+            return False
+        # Flux cut off at the window edge would ring and be shifted out of the window
+        if not self.noise_level or self._edge_flux > self.shift_edge_tolerance * self.noise_level * self.model_image.pixelscale**2:
+            return False
+        shift = np.array(self["center"].get_values()) - self._rendered_center
+        return np.all(np.abs(shift) <= self.shift_tolerance * self.model_image.pixelscale)
+
+    def shift_center(self):
+        if self.is_shifted:
+            return
+        self.is_shifted = True
+        if self._rendered_center is None:
+            return
+        shift = (np.array(self["center"].get_values()) - self._rendered_center) / self.model_image.pixelscale
+        pad = self.shift_padding
+        if self._shift_reference is None:
+            if np.all(shift == 0):
+                return
+            # Shifts are always applied to the last rendered image so that errors don't accumulate
+            self._shift_reference = (np.fft.rfft2(np.pad(self.model_image.data, pad)), self._rendered_amplitude)
+        spectrum, amplitude = self._shift_reference
+        shape = tuple(np.array(self.model_image.data.shape) + 2 * pad)
+        shifted = fft_shift(spectrum, shift[1], shift[0], shape)
+        self.model_image.data = np.ascontiguousarray(shifted[pad:shape[0] - pad, pad:shape[1] - pad])
+        self._rendered_amplitude = amplitude
+        
+    def rescale_amplitude(self):
+        if self.is_scaled:
+            return
+        self.is_scaled = True
+        if self.amplitude_parameter is None:
+            return
+        # The image was rendered at a different amplitude, rescale it in place
+        amplitude = self[self.amplitude_parameter].value
+        if self._rendered_amplitude is None or amplitude == self._rendered_amplitude:
+            return
+        self.model_image.data *= amplitude / self._rendered_amplitude
+        if self.model_integrate is not None:
+            self.model_integrate.data *= amplitude / self._rendered_amplitude
+        self._rendered_amplitude = amplitude
+        
     def compute_loss(self, data):
         # If the image is locked, no need to compute the loss
         if self.locked:
             return
         # Basic loss is the mean Chi^2 error in the window
-        if self.loss_speed_factor == 1:
-            self.loss = {"global": np.mean(data.loss_image[self.window].data)}
-        else:
-            self.loss = {"global": np.mean(data.loss_image[self.window].data[::self.loss_speed_factor,::self.loss_speed_factor])}
+        self.loss = {"global": data.window_loss(self.window, self.loss_speed_factor)}
         
     ######################################################################
     from ._model_methods import _set_default_parameters
     from ._model_methods import step_iteration
+    from ._model_methods import check_updates
     from ._model_methods import set_target
     from ._model_methods import set_window
     from ._model_methods import scale_window
+    from ._model_methods import center_window
     from ._model_methods import update_locked
     from ._model_methods import build_parameter_specs
     from ._model_methods import build_parameter_qualities
     from ._model_methods import build_parameters
+    from ._model_methods import profile_spline
+    from ._model_methods import geometry_map
+    from ._model_methods import _parameter_values
+    from ._model_methods import _parameter_distance
     from ._model_methods import save_model
     from ._model_methods import __getitem__
 
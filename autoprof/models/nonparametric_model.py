@@ -1,13 +1,12 @@
 from .galaxy_model_object import Galaxy_Model
 from .warp_model import Warp_Galaxy
-from .parameter_object import Parameter_Array
 from autoprof.utils.initialize import isophotes
 from autoprof.utils.parametric_profiles import sersic
+from autoprof.utils.interpolate import cubic_spline_evaluate, cubic_spline_derivative
 from autoprof.utils.conversions.coordinates import Rotate_Cartesian, coord_to_index, index_to_coord
 import numpy as np
 from scipy.stats import iqr
 from scipy.optimize import minimize
-from scipy.interpolate import UnivariateSpline
 
 class NonParametric_Galaxy(Galaxy_Model):
 
@@ -24,18 +23,6 @@ class NonParametric_Galaxy(Galaxy_Model):
             self.profR = None
         super().__init__(*args, **kwargs)
         
-    def build_parameters(self):
-        super().build_parameters()
-        for p in self.parameter_specs:
-            if "(R)" not in p:
-                continue
-            if isinstance(self.parameter_specs[p], dict):
-                self.parameters[p] = Parameter_Array(p, **self.parameter_specs[p])
-            elif isinstance(self.parameter_specs[p], Parameter_Array):
-                self.parameters[p] = self.parameter_specs[p]
-            else:
-                raise ValueError(f"unrecognized parameter specification for {p}")
-            
     def set_window(self, *args, **kwargs):
         super().set_window(*args, **kwargs)
 
@@ -72,25 +59,28 @@ class NonParametric_Galaxy(Galaxy_Model):
 
         super().compute_loss(data)
 
-        X, Y = data.loss_image.get_coordinate_meshgrid(self["center"][0].value, self["center"][1].value)
-        if self.loss_speed_factor != 1:
-            X = X[::self.loss_speed_factor,::self.loss_speed_factor]
-            Y = Y[::self.loss_speed_factor,::self.loss_speed_factor]        
-        X, Y = self.transform_coordinates(X, Y)
-        R = self.radius_metric(X, Y)
-        reg = self._regularize_loss()
-        rad_bins = [self.profR[0]] + list((self.profR[:-1] + self.profR[1:])/2) + [self.profR[-1]*100]
-            
-        temp_loss = binned_statistic(R.ravel(), data.loss_image.data.ravel(), statistic = 'mean', bins = rad_bins)[0]
-                            
-        self.loss["radial loss"] = np.array(temp_loss)
+        rad_bins = np.concatenate(([self.profR[0]], (self.profR[:-1] + self.profR[1:])/2, [self.profR[-1]*100]))
+        self.loss["radial loss"] = self.radial_loss(data.loss_image, rad_bins)
 
         
     def radial_model(self, R, sample_image = None):
         if sample_image is None:
-            sample_image = self.model_image        
-        I = UnivariateSpline(self.profR, self["I(R)"].get_values() * sample_image.pixelscale**2, ext = "const", s = 0)
-        return I(R)
+            sample_image = self.model_image
+        coefs = self.profile_spline("I(R)", self.profR, self["I(R)"].get_values())
+        return cubic_spline_evaluate(self.profR, coefs, R) * sample_image.pixelscale**2
+
+    def radial_derivatives(self, R, sample_image, names):
+        coefs = self.profile_spline("I(R)", self.profR, self["I(R)"].get_values())
+        slope = cubic_spline_derivative(self.profR, coefs, R) * sample_image.pixelscale**2
+        # The spline is linear in the profile values, so each derivative is the spline through a unit vector
+        elements = list(i for i in range(len(self.profR)) if f"I(R):{i}" in names)
+        derivatives = {}
+        if len(elements) > 0:
+            basis = self.profile_spline("I(R) basis", self.profR, np.eye(len(self.profR)))
+            values = cubic_spline_evaluate(self.profR, basis[..., elements], R) * sample_image.pixelscale**2
+            for k, i in enumerate(elements):
+                derivatives[f"I(R):{i}"] = values[..., k]
+        return slope, derivatives
 
 
 class NonParametric_Warp(Warp_Galaxy):
@@ -125,9 +115,9 @@ class NonParametric_Warp(Warp_Galaxy):
         
     def radial_model(self, R, sample_image = None):
         if sample_image is None:
-            sample_image = self.model_image        
-        I = UnivariateSpline(self.profR, self["I(R)"].get_values() * sample_image.pixelscale**2, ext = "const", s = 0)
-        return I(R)
+            sample_image = self.model_image
+        coefs = self.profile_spline("I(R)", self.profR, self["I(R)"].get_values())
+        return cubic_spline_evaluate(self.profR, coefs, R) * sample_image.pixelscale**2
 
     def compute_loss(self, data):
         # If the image is locked, no need to compute the loss
@@ -136,15 +126,5 @@ class NonParametric_Warp(Warp_Galaxy):
 
         super().compute_loss(data)
 
-        X, Y = data.loss_image.get_coordinate_meshgrid(self["center"][0].value, self["center"][1].value)
-        if self.loss_speed_factor != 1:
-            X = X[::self.loss_speed_factor,::self.loss_speed_factor]
-            Y = Y[::self.loss_speed_factor,::self.loss_speed_factor]
-        X, Y = self.transform_coordinates(X, Y)
-        R = self.radius_metric(X, Y)
-        reg = self._regularize_loss()
-        rad_bins = [self.profR[0]] + list((self.profR[:-1] + self.profR[1:])/2) + [self.profR[-1]*100]
-            
-        temp_loss = binned_statistic(R.ravel(), data.loss_image.data.ravel(), statistic = 'mean', bins = rad_bins)[0]
-                            
-        self.loss["radial loss"] = np.array(temp_loss)
+        rad_bins = np.concatenate(([self.profR[0]], (self.profR[:-1] + self.profR[1:])/2, [self.profR[-1]*100]))
+        self.loss["radial loss"] = self.radial_loss(data.loss_image, rad_bins)
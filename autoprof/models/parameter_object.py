@@ -1,56 +1,232 @@
 import numpy as np
-from autoprof.utils.conversions.optimization import boundaries, inv_boundaries, cyclic_boundaries, cyclic_difference
+from autoprof.utils.conversions.optimization import boundaries, inv_boundaries, d_inv_boundaries, cyclic_boundaries, cyclic_difference
 from copy import deepcopy
 
+class Parameter_Vector(object):
+    """
+    Contiguous storage for the values, representations and uncertainties of a set of parameters.
+    Each Parameter is a view onto one element of a vector, so optimizers can read and write the
+    parameters of a whole model at once with the vectorized get/set methods. Elements are
+    addressed by their index, or by name through index().
+    """
+
+    def __init__(self):
+        self.names = []
+        self._lookup = {}
+        self.values = np.zeros(0)
+        self.representation = np.zeros(0)
+        self.uncertainty = np.zeros(0)
+        self.defined = np.zeros(0, dtype = bool)
+        self.fixed = np.zeros(0, dtype = bool)
+        self.cyclic = np.zeros(0, dtype = bool)
+        self.lower = np.zeros(0)
+        self.upper = np.zeros(0)
+        self.versions = np.zeros(0, dtype = int)
+
+    def add(self, name, limits = None, cyclic = False, fixed = False):
+        """
+        Add an element to the vector and return its index.
+        """
+        self._lookup[name] = len(self.names)
+        self.names.append(name)
+        self.values = np.append(self.values, 0.)
+        self.representation = np.append(self.representation, 0.)
+        self.uncertainty = np.append(self.uncertainty, np.nan)
+        self.defined = np.append(self.defined, False)
+        self.fixed = np.append(self.fixed, bool(fixed))
+        self.cyclic = np.append(self.cyclic, bool(cyclic))
+        self.lower = np.append(self.lower, -np.inf if limits is None or limits[0] is None else limits[0])
+        self.upper = np.append(self.upper, np.inf if limits is None or limits[1] is None else limits[1])
+        self.versions = np.append(self.versions, 0)
+        return self._lookup[name]
+
+    def index(self, names):
+        """
+        Index of an element by name, or an array of indices for a list of names.
+        """
+        if isinstance(names, str):
+            return self._lookup[names]
+        return np.array(list(self._lookup[name] for name in names), dtype = int)
+
+    def __contains__(self, name):
+        return name in self._lookup
+
+    def __len__(self):
+        return len(self.names)
+
+    def _indices(self, indices):
+        if indices is None:
+            return np.arange(len(self.names))
+        return np.atleast_1d(np.asarray(indices))
+
+    def _limit_masks(self, indices):
+        has_lower = np.isfinite(self.lower[indices])
+        has_upper = np.isfinite(self.upper[indices])
+        cyclic = self.cyclic[indices]
+        return has_lower & has_upper & ~cyclic, has_lower & ~has_upper & ~cyclic, ~has_lower & has_upper & ~cyclic
+
+    def to_representation(self, values, indices = None):
+        """
+        Map values within the limits to representations in the range -inf to inf.
+        """
+        indices = self._indices(indices)
+        representation = np.array(values, dtype = float)
+        both, lower, upper = self._limit_masks(indices)
+        representation[both] = boundaries(representation[both], (self.lower[indices][both], self.upper[indices][both]))
+        representation[lower] = boundaries(representation[lower], (self.lower[indices][lower], None))
+        representation[upper] = boundaries(representation[upper], (None, self.upper[indices][upper]))
+        return representation
+
+    def to_values(self, representation, indices = None):
+        """
+        Map representations in the range -inf to inf back to values within the limits.
+        """
+        indices = self._indices(indices)
+        values = np.array(representation, dtype = float)
+        both, lower, upper = self._limit_masks(indices)
+        values[both] = inv_boundaries(values[both], (self.lower[indices][both], self.upper[indices][both]))
+        values[lower] = inv_boundaries(values[lower], (self.lower[indices][lower], None))
+        values[upper] = inv_boundaries(values[upper], (None, self.upper[indices][upper]))
+        return values
+
+    def values_derivative(self, indices = None):
+        """
+        Derivative of each value with respect to its representation, at the current values.
+        """
+        indices = self._indices(indices)
+        derivative = np.ones(len(indices))
+        representation = self.representation[indices]
+        both, lower, upper = self._limit_masks(indices)
+        derivative[both] = d_inv_boundaries(representation[both], (self.lower[indices][both], self.upper[indices][both]))
+        derivative[lower] = d_inv_boundaries(representation[lower], (self.lower[indices][lower], None))
+        derivative[upper] = d_inv_boundaries(representation[upper], (None, self.upper[indices][upper]))
+        return derivative
+
+    def set_values(self, values, indices = None, override_fixed = False):
+        indices = self._indices(indices)
+        values = np.broadcast_to(np.asarray(values, dtype = float), indices.shape).copy()
+        if not override_fixed:
+            free = ~self.fixed[indices]
+            indices = indices[free]
+            values = values[free]
+        cyclic = self.cyclic[indices]
+        values[cyclic] = cyclic_boundaries(values[cyclic], (self.lower[indices][cyclic], self.upper[indices][cyclic]))
+        assert np.all((values > self.lower[indices]) | cyclic | np.isinf(self.lower[indices]))
+        assert np.all((values < self.upper[indices]) | cyclic | np.isinf(self.upper[indices]))
+        changed = ~self.defined[indices] | (self.values[indices] != values)
+        self.versions[indices[changed]] += 1
+        self.values[indices] = values
+        self.defined[indices] = True
+        self.representation[indices] = self.to_representation(values, indices)
+
+    def set_representation(self, representation, indices = None, override_fixed = False):
+        indices = self._indices(indices)
+        self.set_values(self.to_values(np.broadcast_to(representation, indices.shape), indices), indices, override_fixed)
+
+    def set_uncertainty(self, uncertainty, indices = None, override_fixed = False):
+        indices = self._indices(indices)
+        uncertainty = np.broadcast_to(np.asarray(uncertainty, dtype = float), indices.shape)
+        if not override_fixed:
+            free = ~self.fixed[indices]
+            indices = indices[free]
+            uncertainty = uncertainty[free]
+        if np.any(uncertainty < 0):
+            raise ValueError(f"Uncertainty should be a positive real value, not {uncertainty}")
+        self.uncertainty[indices] = uncertainty
+
+    def get_values(self, indices = None):
+        return self.values[self._indices(indices)]
+
+    def get_representation(self, indices = None):
+        return self.representation[self._indices(indices)]
+
+    def get_uncertainty(self, indices = None):
+        return self.uncertainty[self._indices(indices)]
+
+    def difference(self, representation1, representation2, indices = None):
+        """
+        Difference of two representations, wrapping around for cyclic parameters.
+        """
+        indices = self._indices(indices)
+        diff = np.asarray(representation1, dtype = float) - np.asarray(representation2, dtype = float)
+        cyclic = self.cyclic[indices]
+        if np.any(cyclic):
+            period = (self.upper[indices] - self.lower[indices])[cyclic]
+            diff[..., cyclic] = cyclic_difference(diff[..., cyclic], 0., period)
+        return diff
+
 class Parameter(object):
 
-    def __init__(self, name, **kwargs):
+    def __init__(self, name, vector = None, **kwargs):
 
         self.name = name
         
         self.limits = kwargs.get("limits", None)
         self.cyclic = kwargs.get("cyclic", False)
         self.user_fixed = kwargs.get("fixed", None)
+        self.units = kwargs.get("units", "none")
+        self._vector = Parameter_Vector() if vector is None else vector
+        self._index = self._vector.add(name, limits = self.limits, cyclic = self.cyclic, fixed = self.user_fixed)
         self.update_fixed(False)
-        self.value = None
-        self.representation = None
-        if "value" in kwargs:
+        uncertainty = kwargs.get("uncertainty", None)
+        if uncertainty is not None:
+            self.set_uncertainty(uncertainty, override_fixed = True)
+        if "value" in kwargs and kwargs["value"] is not None:
             self.set_value(kwargs["value"], override_fixed = True)
-        self.units = kwargs.get("units", "none")
-        self.uncertainty = kwargs.get("uncertainty", None)
+
+    @property
+    def value(self):
+        if not self._vector.defined[self._index]:
+            return None
+        return self._vector.values[self._index]
+
+    @property
+    def representation(self):
+        if not self._vector.defined[self._index]:
+            return None
+        return self._vector.representation[self._index]
+
+    @property
+    def uncertainty(self):
+        uncertainty = self._vector.uncertainty[self._index]
+        return None if np.isnan(uncertainty) else uncertainty
+
+    @uncertainty.setter
+    def uncertainty(self, uncertainty):
+        self._vector.uncertainty[self._index] = np.nan if uncertainty is None else uncertainty
+
+    @property
+    def fixed(self):
+        return bool(self._vector.fixed[self._index])
+    
+    @property
+    def version(self):
+        """
+        Counter which increases every time the parameter value changes.
+        """
+        return self._vector.versions[self._index]
 
     def update_fixed(self, fixed):
-        self.fixed = fixed or bool(self.user_fixed)
+        self._vector.fixed[self._index] = fixed or bool(self.user_fixed)
+
+    def move_to(self, vector):
+        """
+        Move the storage for this parameter into another Parameter_Vector, keeping its state.
+        """
+        old, i = self._vector, self._index
+        self._index = vector.add(self.name, limits = self.limits, cyclic = self.cyclic, fixed = old.fixed[i])
+        for attr in ["values", "representation", "uncertainty", "defined", "versions"]:
+            getattr(vector, attr)[self._index] = getattr(old, attr)[i]
+        self._vector = vector
 
     def set_uncertainty(self, uncertainty, override_fixed = False):
-        if self.fixed and not override_fixed:
-            return
-        if np.any(uncertainty < 0):
-            raise ValueError(f"{name} Uncertainty should be a positive real value, not {uncertainty}")
-        self.uncertainty = uncertainty
+        self._vector.set_uncertainty(uncertainty, self._index, override_fixed)
         
     def set_value(self, value, override_fixed = False):
-        if self.fixed and not override_fixed:
-            return
-        if self.cyclic:
-            self.value = cyclic_boundaries(value, self.limits)
-            self.representation = self.value
-            return
-        self.value = value
-        if self.limits is None:
-            self.representation = self.value
-        else:
-            assert self.limits[0] is None or value > self.limits[0]
-            assert self.limits[1] is None or value < self.limits[1]
-            self.representation = boundaries(self.value, self.limits)
+        self._vector.set_values(value, self._index, override_fixed)
         
     def set_representation(self, representation, override_fixed = False):
-        if self.fixed and not override_fixed:
-            return
-        if self.limits is None or self.cyclic:
-            self.set_value(representation, override_fixed)
-        else:
-            self.set_value(inv_boundaries(representation, self.limits), override_fixed)
+        self._vector.set_representation(representation, self._index, override_fixed)
 
     def __str__(self):
         return f"{self.name}: {self.value} +- {self.uncertainty} [{self.units}{'' if self.fixed is False else ', fixed'}{'' if self.limits is None else (', ' + str(self.limits))}{'' if self.cyclic is False else ', cyclic'}]"
@@ -63,89 +239,155 @@ class Parameter(object):
         return self.representation - other.representation
 
 class Parameter_Array(Parameter):
+    """
+    Array of parameters stored in consecutive elements of a Parameter_Vector. The elements are
+    only created once the first value is set, since that determines the length of the array.
+    """
+
+    def __init__(self, name, vector = None, **kwargs):
+
+        self.name = name
+        
+        self.limits = kwargs.get("limits", None)
+        self.cyclic = kwargs.get("cyclic", False)
+        self.user_fixed = kwargs.get("fixed", None)
+        self.units = kwargs.get("units", "none")
+        self._vector = Parameter_Vector() if vector is None else vector
+        self._elements = None
+        self._indices = None
+        self._version = 0
+        self.update_fixed(False)
+        self.uncertainty = kwargs.get("uncertainty", None)
+        if "value" in kwargs and kwargs["value"] is not None:
+            self.set_value(kwargs["value"], override_fixed = True)
+
+    @property
+    def value(self):
+        return self._elements
+
+    @property
+    def representation(self):
+        if self._elements is None:
+            return None
+        return self._vector.representation[self._indices]
+
+    @property
+    def uncertainty(self):
+        return self._uncertainty
+
+    @uncertainty.setter
+    def uncertainty(self, uncertainty):
+        self._uncertainty = uncertainty
+
+    @property
+    def fixed(self):
+        return self._fixed
+    
+    @property
+    def version(self):
+        """
+        Counter which increases every time any element of the array changes.
+        """
+        if self._elements is None:
+            return self._version
+        return self._version + int(np.sum(self._vector.versions[self._indices]))
+
+    def update_fixed(self, fixed):
+        self._fixed = fixed or bool(self.user_fixed)
+        if self._elements is not None:
+            for element in self._elements:
+                element.update_fixed(fixed)
+    
+    def move_to(self, vector):
+        self._vector = vector
+        if self._elements is None:
+            return
+        for element in self._elements:
+            element.move_to(vector)
+        self._indices = np.array(list(element._index for element in self._elements), dtype = int)
     
     def set_value(self, value, override_fixed = False, index = None):
-        if self.value is None:
-            self.value = []
-            for i, val in enumerate(value):
-                self.value.append(Parameter(
-                    name = f"{self.name}:{i}",
-                    limits = self.limits,
-                    cyclic = self.cyclic,
-                    fixed = self.user_fixed,
-                    value = val,
-                    units = self.units,
-                    uncertainty = self.uncertainty
-                ))
+        if self._elements is None:
+            self._version += 1
+            self._elements = list(Parameter(
+                name = f"{self.name}:{i}",
+                vector = self._vector,
+                limits = self.limits,
+                cyclic = self.cyclic,
+                fixed = self.user_fixed,
+                units = self.units,
+                uncertainty = self.uncertainty,
+            ) for i in range(len(value)))
+            self._indices = np.array(list(element._index for element in self._elements), dtype = int)
+            override_fixed = True
         if index is None:
-            for i in range(len(self.value)):
-                self.value[i].set_value(value[i], override_fixed)
+            self._vector.set_values(value, self._indices, override_fixed)
         else:
-            self.value[index].set_value(value, override_fixed)
+            self._elements[index].set_value(value, override_fixed)
 
     def get_values(self):
-        return np.array(list(V.value for V in self.value))
+        return self._vector.values[self._indices]
         
     def set_representation(self, representation, override_fixed = False, index = None):
-        
         if index is None:
-            for i in range(len(self.value)):
-                self.value[i].set_representation(representation[i], override_fixed)
+            self._vector.set_representation(representation, self._indices, override_fixed)
         else:
-            self.value[index].set_representation(representation, override_fixed)
+            self._elements[index].set_representation(representation, override_fixed)
 
     def set_uncertainty(self, uncertainty, override_fixed = False, index = None):
         if index is None:
-            for i in range(len(self.value)):
-                self.value[i].set_uncertainty(uncertainty[i], override_fixed)
+            self._vector.set_uncertainty(uncertainty, self._indices, override_fixed)
         else:
-            self.value[index].set_uncertainty(uncertainty, override_fixed)
-        
+            self._elements[index].set_uncertainty(uncertainty, override_fixed)
         
     def __sub__(self, other):
-        res = np.zeros(len(self.value))
-        for i in range(len(self.value)):
-            if isinstance(other, Parameter_Array):
-                res[i] = self.value[i] - other.value[i]
-            elif isinstance(other, Parameter):
-                res[i] = self.value[i] - other
-            else:
-                raise ValueError(f"unrecognized parameter type: {type(other)}")
-            
-        return res
+        if isinstance(other, Parameter_Array):
+            return self._vector.difference(self.representation, other.representation, self._indices)
+        elif isinstance(other, Parameter):
+            return self._vector.difference(self.representation, other.representation, self._indices)
+        raise ValueError(f"unrecognized parameter type: {type(other)}")
 
     def __iter__(self):
-        self.i = -1
-        return self
-    def __next__(self):
-        self.i += 1
-        if self.i < len(self.value):
-            return self[self.i]
-        else:
-            raise StopIteration
+        return iter(self._elements)
     
     def __getitem__(self, S):
-        try:
-            return self.value[S]
-        except KeyError:
-            for v in self.value:
+        if isinstance(S, str):
+            for v in self._elements:
                 if S == v.name:
                     return v
             raise KeyError(f"{S} not in {self.name}. {str(self)}")
+        return self._elements[S]
 
     def __str__(self):
-        return "\n".join([f"{self.name}:"] + list(str(val) for val in self.value))
+        return "\n".join([f"{self.name}:"] + list(str(val) for val in self._elements))
         
     def __len__(self):
-        return len(self.value)
-
+        return len(self._elements)
 
 class Optimize_History(object):
+    """
+    Record of the parameter representations and losses of a model at each step of the fit.
+    Steps are written into preallocated ring buffers holding the most recent "depth" steps, and
+    are read back most recent first. If a memmap filename is given, steps pushed out of the ring
+    buffer are appended to that file (global loss followed by the representations) so the full
+    history can still be read with spilled_history.
+    """
 
-    def __init__(self, model):
+    def __init__(self, model, depth = 64, memmap = None):
         self.name = model.name
-        self.parameter_history = []
-        self.loss_history = []
+        self.depth = depth
+        self.memmap = memmap
+        self.parameters = model.parameters
+        self.vector = model.parameter_vector
+        self.steps = 0
+        # Step from which losses are comparable, see rebaseline
+        self.baseline = 0
+        self._width = None
+        self._representation = None
+        self._fixed = None
+        self._loss = {}
+        self._columns = {}
+        self._spill_width = None
         self.map_loss_quality = {"global": set()}
         for param in model.parameters:
             if "loss" in model.parameter_qualities[param]:
@@ -156,90 +398,139 @@ class Optimize_History(object):
             else:
                 self.map_loss_quality["global"].add(param)
 
+    def __len__(self):
+        return min(self.steps, self.depth)
+
+    @property
+    def loss_qualities(self):
+        return list(self._loss.keys())
+
+    def _allocate(self, width):
+        # Parameter arrays can add elements to the vector, keep the columns recorded so far
+        representation = np.full((self.depth, width), np.nan)
+        fixed = np.ones((self.depth, width), dtype = bool)
+        if self._width is not None:
+            keep = min(width, self._width)
+            representation[:, :keep] = self._representation[:, :keep]
+            fixed[:, :keep] = self._fixed[:, :keep]
+        self._representation = representation
+        self._fixed = fixed
+        self._width = width
+        self._columns = {}
+
+    def _spill(self, row):
+        if self._spill_width is None:
+            self._spill_width = self._width
+            open(self.memmap, "wb").close()
+        spill = np.full(self._spill_width + 1, np.nan)
+        spill[0] = self._loss["global"][row] if "global" in self._loss else np.nan
+        keep = min(self._spill_width, self._width)
+        spill[1:keep + 1] = self._representation[row, :keep]
+        with open(self.memmap, "ab") as f:
+            f.write(spill.tobytes())
+
     def add_step(self, params, loss):
-        self.parameter_history.insert(0, deepcopy(params))
-        self.loss_history.insert(0, deepcopy(loss))
+        """
+        Record the current state of the parameter vector along with the loss it produced.
+        """
+        if self._width != len(self.vector):
+            self._allocate(len(self.vector))
+        row = self.steps % self.depth
+        if self.memmap is not None and self.steps >= self.depth:
+            self._spill(row)
+        self._representation[row] = self.vector.representation
+        self._fixed[row] = self.vector.fixed
+        for loss_quality in loss:
+            value = np.asarray(loss[loss_quality], dtype = float)
+            if loss_quality not in self._loss or self._loss[loss_quality].shape[1:] != value.shape:
+                self._loss[loss_quality] = np.full((self.depth,) + value.shape, np.nan)
+            self._loss[loss_quality][row] = value
+        self.steps += 1
+
+    def _rows(self, limit = np.inf):
+        # Ring buffer rows from the most recent step backwards
+        N = int(min(len(self), limit))
+        return (self.steps - 1 - np.arange(N)) % self.depth
 
-    def get_parameters(self, index=0, exclude_fixed = False, quality = None):
+    def columns(self, loss_quality, element = None):
         """
-        index: index of the parameter history where 0 is most recent and -1 is first
-        exclude_fixed: ignore parameters currently set to fixed
-        quality: select for a parameter quality, should be a tuple of length 2. first element is the quality name, second is the desired value.
+        Vector indices of the parameters optimized by a loss quality. For vector losses, element
+        selects the matching element of each parameter array. Index lists are cached until the
+        vector changes size.
         """
-        use_params = self.parameter_history[index]
-        
-        # Return all parameters for a given iteration
-        if not exclude_fixed and quality is None:
-            return self.parameter_history[index]
-        return_parameters = {}
-        for p in self.parameter_history[index]:
-            # Skip currently fixed parameters since they cannot be updated anyway
-            if (exclude_fixed and self.parameter_history[index][p].fixed) or (quality is not None and p not in self.map_loss_quality[quality]):
-                continue
-            # Return representation which is valid in [-inf, inf] range
-            return_parameters[p] = self.parameter_history[index][p]
-        return return_parameters
+        key = (loss_quality, element)
+        if key not in self._columns:
+            columns = []
+            for p in self.parameters:
+                if p not in self.map_loss_quality.get(loss_quality, ()):
+                    continue
+                if isinstance(self.parameters[p], Parameter_Array):
+                    if self.parameters[p].value is None:
+                        continue
+                    if element is None:
+                        columns += list(self.parameters[p]._indices)
+                    elif element < len(self.parameters[p]._indices):
+                        columns.append(self.parameters[p]._indices[element])
+                else:
+                    columns.append(self.parameters[p]._index)
+            self._columns[key] = np.array(columns, dtype = int)
+        return self._columns[key]
 
-    def get_loss(self, index=0, parameter = None, loss_quality = "global"):
+    def get_loss(self, index = 0, loss_quality = "global"):
         """
         Return a loss value for this model.
-        index: index of the loss history where 0 is most recent and -1 is first
-        parameter: return the loss associated with this parameter, defaults to "global"
+        index: index of the loss history where 0 is most recent
         loss_quality: directly request a specific loss calculation, defaults to "global"
         """
-        loss_dict = self.loss_history[index]
-        
-        if parameter is not None:
-            for mlq in self.map_loss_quality:
-                if parameter in self.map_loss_quality[mlq]:
-                    return loss_dict[mlq]
-            else:
-                return loss_dict["global"]
-        return loss_dict[loss_quality]
+        return self._loss[loss_quality][self._rows()[index]]
+
+    def loss_series(self, loss_quality = "global"):
+        """
+        All the recorded values of a loss quality in the order they were computed, including
+        spilled steps for the global loss.
+        """
+        series = self._loss[loss_quality][self._rows()[::-1]]
+        if loss_quality == "global" and self._spill_width is not None:
+            series = np.concatenate((self.spilled_history()[:,0], series))
+        return series
+
+    def rebaseline(self):
+        """
+        Start comparing losses afresh, for when the pixels the loss is measured on have changed
+        (such as after the model window is resized). Earlier steps are kept for the loss series,
+        but are no longer returned by get_loss_history.
+        """
+        self.baseline = self.steps
+
+    def spilled_history(self):
+        """
+        Memory map of the steps that have been pushed out of the ring buffer, each row is the
+        global loss followed by the parameter representations.
+        """
+        return np.memmap(self.memmap, dtype = float, mode = "r").reshape(-1, self._spill_width + 1)
     
     def get_loss_history(self, limit = np.inf):
+        """
+        Return a dictionary with an entry for each loss quality (and each element of vector
+        losses) of the form (loss, indices, representation). Where loss holds the most recent
+        steps up to limit, indices are the vector indices of the free parameters optimized by
+        that loss, and representation holds their values at each step.
+        """
         loss_history = {}
-        for loss_quality in self.map_loss_quality.keys():
-            # All global parameters
-            param_order = self.get_parameters(exclude_fixed = True, quality = ["loss", loss_quality]).keys()
-            
-            # handle loss vector instances
-            if not isinstance(self.get_loss(loss_quality = loss_quality), float):
-                for il in range(len(self.get_loss(loss_quality = loss_quality))):
-                    params = []
-                    loss = []
-                    for i in range(min(limit, len(self.loss_history))):
-                        params_i = self.get_parameters(index = i, exclude_fixed = True, quality = ["loss", loss_quality])
-                        sub_params = []
-                        for P in param_order:
-                            if isinstance(params_i[P], Parameter_Array):
-                                if self.parameters[P][il].fixed:
-                                    continue
-                                sub_params.append(params_i[P][il])
-                            elif isinstance(params_i[P], Parameter):
-                                sub_params.append(params_i[P])
-                        params.append(np.array(sub_params))
-                        loss.append(self.get_loss(index = i, loss_quality = loss_quality)[il])
-                    loss_history[f"{loss_quality}:{il}"] = (loss, params)
+        rows = self._rows(min(limit, self.steps - self.baseline))
+        if len(rows) == 0:
+            return loss_history
+        free = ~self._fixed[rows[0]]
+        for loss_quality in self.map_loss_quality:
+            if loss_quality not in self._loss:
                 continue
-
-            # handle regular loss values
-            params = []
-            loss = []
-            for i in range(min(limit, len(self.loss_history))):
-                params_i = self.get_parameters(index = i, exclude_fixed = True, quality = ["loss", loss_quality])
-                sub_params = []
-                for P in param_order:
-                    if isinstance(params_i[P], Parameter_Array):
-                        for ip in range(len(params_i[P])):
-                            if self.parameters[P][ip].fixed:
-                                continue
-                            sub_params.append(params_i[P][ip])
-                    elif isinstance(params_i[P], Parameter):
-                        sub_params.append(params_i[P])
-                params.append(np.array(sub_params))
-                loss.append(self.get_loss(index = i, loss_quality = loss_quality))
-            loss_history[loss_quality] = (loss, params)
+            loss = self._loss[loss_quality][rows]
+            if loss.ndim == 1:
+                keys = [(loss_quality, None)]
+            else:
+                keys = list((f"{loss_quality}:{il}", il) for il in range(loss.shape[1]))
+            for key, element in keys:
+                indices = self.columns(loss_quality, element)
+                indices = indices[free[indices]]
+                loss_history[key] = (loss if element is None else loss[:, element], indices, self._representation[np.ix_(rows, indices)])
         return loss_history
-        
-        
@@ -17,10 +17,15 @@ class Sersic_Galaxy(Galaxy_Model):
         "Rs": {"units": "arcsec", "limits": (0,None)},
     }
     parameter_qualities = {
-        "I0": {"form": "value", "loss": "global"},
+        "I0": {"form": "value", "loss": "global", "stages": ("amplitude",)},
         "n": {"form": "value", "loss": "global"},
         "Rs": {"form": "value", "loss": "global"},
     }
+    amplitude_parameter = "I0"
+    # The vectorized closed form profile is cheaper to evaluate directly than through a lookup
+    # table, or than interpolating reflected pixels when the center is off the pixel grid
+    profile_lookup = False
+    symmetric_sampling = False
 
     def initialize(self, target = None):
         if target is None:
@@ -69,6 +74,22 @@ class Sersic_Galaxy(Galaxy_Model):
             sample_image = self.model_image        
         return sersic(R, self["n"].value, self["Rs"].value, self["I0"].value * sample_image.pixelscale**2)
 
+    def radial_derivatives(self, R, sample_image, names):
+        n, Rs, I0 = self["n"].value, self["Rs"].value, self["I0"].value
+        unit = sersic(R, n, Rs, sample_image.pixelscale**2)
+        # The profile is I0 exp(-u) with u = (R/Rs)^(1/n)
+        u = (R / Rs)**(1 / n)
+        flux = I0 * unit * u / n
+        derivatives = {}
+        if "I0" in names:
+            derivatives["I0"] = unit
+        if "Rs" in names:
+            derivatives["Rs"] = flux / Rs
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            if "n" in names:
+                derivatives["n"] = np.where(R > 0, flux * np.log(R / Rs) / n, 0.)
+            return np.where(R > 0, -flux / R, 0.), derivatives
+
     
 class Sersic_Warp(Warp_Galaxy):
 
@@ -79,10 +100,13 @@ class Sersic_Warp(Warp_Galaxy):
         "Rs": {"units": "arcsec", "limits": (0,None)},
     }
     parameter_qualities = {
-        "I0": {"form": "value", "loss": "global"},
+        "I0": {"form": "value", "loss": "global", "stages": ("amplitude",)},
         "n": {"form": "value", "loss": "global"},
         "Rs": {"form": "value", "loss": "global"},
     }
+    amplitude_parameter = "I0"
+    # The vectorized closed form profile is cheaper to evaluate directly than through a lookup table
+    profile_lookup = False
 
     def initialize(self, target = None):
         if target is None:
@@ -1,13 +1,12 @@
 from .galaxy_model_object import Galaxy_Model
 from .parameter_object import Parameter_Array
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 from autoprof.utils.initialize import isophotes
-from autoprof.utils.interpolate import nearest_neighbor
+from autoprof.utils.interpolate import nearest_neighbor, cubic_spline_evaluate
 from autoprof.utils.angle_operations import Angle_Average
 from autoprof.utils.conversions.coordinates import Rotate_Cartesian, Axis_Ratio_Cartesian, coord_to_index, index_to_coord
-from scipy.fftpack import fft, ifft
-from scipy.stats import iqr, binned_statistic, binned_statistic_2d
+from autoprof.utils.agregate_pixel import segment_median
+from scipy.stats import iqr
 import matplotlib.pyplot as plt
 from astropy.visualization import SqrtStretch, LogStretch, HistEqStretch
 from astropy.visualization.mpl_normalize import ImageNormalize
@@ -25,24 +24,15 @@ class Warp_Galaxy(Galaxy_Model):
     }
 
     fft_start = 10
+    # Number of angular segments in each ring for the radial fft2 loss
+    fft_segments = 16
+    geometry_parameters = Galaxy_Model.geometry_parameters + ("q(R)", "PA(R)")
 
     def __init__(self, *args, **kwargs):
         if not hasattr(self, "profR"):
             self.profR = None
         super().__init__(*args, **kwargs)
 
-    def build_parameters(self):
-        super().build_parameters()
-        for p in self.parameter_specs:
-            if "(R)" not in p:
-                continue
-            if isinstance(self.parameter_specs[p], dict):
-                self.parameters[p] = Parameter_Array(p, **self.parameter_specs[p])
-            elif isinstance(self.parameter_specs[p], Parameter_Array):
-                self.parameters[p] = self.parameter_specs[p]
-            else:
-                raise ValueError(f"unrecognized parameter specification for {p}")
-        
     def _init_convert_input_units(self):
         super()._init_convert_input_units()
         
@@ -96,34 +86,61 @@ class Warp_Galaxy(Galaxy_Model):
             self.profR.pop()
             self.profR = np.array(self.profR)
 
+    def derivative_images(self, sample_image, names):
+        # The radius dependent warp has no analytic derivatives
+        return {}
+
     def transform_coordinates(self, X, Y, R = None, transmit = True):
         if transmit:
             X, Y = super().transform_coordinates(X, Y)
 
         if R is None:
             R = self.radius_metric(X, Y)
-        PA = UnivariateSpline(self.profR, np.unwrap(self["PA(R)"].get_values()*2)/2, ext = "const", s = 0)
-        q = UnivariateSpline(self.profR, self["q(R)"].get_values(), ext = "const", s = 0)
+        # Both profiles share knots, so they are evaluated together with a single segment search
+        coefs = self.profile_spline("q(R),PA(R)", self.profR, np.stack((self["q(R)"].get_values(), np.unwrap(self["PA(R)"].get_values()*2)/2), axis = -1))
+        warp = cubic_spline_evaluate(self.profR, coefs, R)
         
-        return Axis_Ratio_Cartesian(q(R), X, Y, PA(R))
+        return Axis_Ratio_Cartesian(warp[...,0], X, Y, warp[...,1])
+
+    def _polar_map(self, image):
+        """
+        Radius and angle of each (loss subsampled) pixel in the frame of the global q and PA.
+        """
+        X, Y = image.get_coordinate_meshgrid(self["center"][0].value, self["center"][1].value)
+        if self.loss_speed_factor != 1:
+            X = X[::self.loss_speed_factor,::self.loss_speed_factor]
+            Y = Y[::self.loss_speed_factor,::self.loss_speed_factor]
+        X, Y = super().transform_coordinates(X, Y)
+        return self.radius_metric(X, Y), np.arctan2(Y, X)
+
+    def _segment_map(self, image, rad_bins):
+        """
+        Index of the (ring, angle) segment of each (loss subsampled) pixel, with overflow segments
+        for pixels beyond the last ring, and the number of pixels in each segment.
+        """
+        R, theta = self._polar_map(image)
+        rings = np.clip(np.digitize(R.ravel(), rad_bins) - 1, 0, len(rad_bins) - 1)
+        angles = np.clip(((theta.ravel() + np.pi) * self.fft_segments / (2*np.pi)).astype(int), 0, self.fft_segments - 1)
+        segments = rings * self.fft_segments + angles
+        return segments, np.bincount(segments, minlength = len(rad_bins) * self.fft_segments)
 
     def _regularize_loss(self):
 
-        params = self.get_parameters(quality = ["regularize", "const"])
-        params.update(self.get_parameters(quality = ["regularize", "self"]))
         regularization = np.ones(len(self.profR))
-        for P in params:
-            if not isinstance(params[P], Parameter_Array):
+        for P in self.parameters:
+            if self.parameter_qualities[P].get("regularize", None) not in ["const", "self"]:
                 continue
-            vals = params[P].get_values()
-            if params[P].cyclic:
-                period_factor = 2*np.pi / (params[P].limits[1] - params[P].limits[0])
+            if not isinstance(self.parameters[P], Parameter_Array) or self.parameters[P].value is None:
+                continue
+            vals = self.parameters[P].get_values()
+            if self.parameters[P].cyclic:
+                period_factor = 2*np.pi / (self.parameters[P].limits[1] - self.parameters[P].limits[0])
                 vals = np.unwrap(vals * period_factor) / period_factor
             if self.parameter_qualities[P]["regularize"] == "const":
                 reg_scale = np.ones(len(self.profR))
             elif self.parameter_qualities[P]["regularize"] == "self":
                 reg_scale = vals
-            reg_scale *= self.parameter_qualities[P]["regularize scale"]
+            reg_scale = reg_scale * self.parameter_qualities[P]["regularize scale"]
             reg = [2*np.abs(vals[1] - vals[0]) / reg_scale[0]]
             for i in range(1, len(vals) - 1):
                 reg.append((np.abs(vals[i] - vals[i-1]) + np.abs(vals[i] - vals[i+1])) / reg_scale[i])
@@ -142,29 +159,24 @@ class Warp_Galaxy(Galaxy_Model):
         if not any(m in self.loss_mode for m in ["default", "radial"]):
             return
 
-        X, Y = data.loss_image.get_coordinate_meshgrid(self["center"][0].value, self["center"][1].value)
-        if self.loss_speed_factor != 1:
-            X = X[::self.loss_speed_factor,::self.loss_speed_factor]
-            Y = Y[::self.loss_speed_factor,::self.loss_speed_factor]
-        X, Y = super().transform_coordinates(X, Y)
-        preR = self.radius_metric(X, Y)
-        preTheta = np.arctan2(Y, X)
         reg = self._regularize_loss()
-        rad_bins = [self.profR[0]] + list((self.profR[:-1] + self.profR[1:])/2) + [self.profR[-1]*100]
-            
-        temp_fft2 = []
-        theta_bins = np.linspace(-np.pi, np.pi, 17)
-        segment_stats = binned_statistic_2d(preR.ravel(), preTheta.ravel(), data.loss_image.data.ravel(), statistic = 'median', bins = [rad_bins, theta_bins])[0]
-        cbins = (theta_bins[:-1] + theta_bins[1:]) / 2 + np.pi
-        for i in range(len(self.profR)):
-            if self.profR[i] < self.fft_start:
-                temp_fft2.append(temp_loss[i])
-            else:
-                smooth = segment_stats[i]
-                N = np.isfinite(smooth)
-                if not np.all(N):
-                    smooth[np.logical_not(N)] = np.interp(cbins[np.logical_not(N)], cbins[N], smooth[N], period = 2*np.pi)
-                coefs = fft(smooth)
-                temp_fft2.append(np.abs(coefs[2]) * reg[i])
-                
-        self.loss["radial fft2"] = np.array(temp_fft2)
+        rad_bins = np.concatenate(([self.profR[0]], (self.profR[:-1] + self.profR[1:])/2, [self.profR[-1]*100]))
+        temp_loss = self.radial_loss(data.loss_image, rad_bins)
+
+        # Median loss in angular segments of each ring, in the frame of the global q and PA
+        segments, counts = self.geometry_map(
+            f"segments {self.loss_speed_factor} {len(rad_bins)}", data.loss_image, Galaxy_Model.geometry_parameters,
+            lambda: self._segment_map(data.loss_image, rad_bins),
+            tolerance = self._geometry_tolerance(data.loss_image, Galaxy_Model.geometry_parameters),
+        )
+        segment_stats = segment_median(data.loss_image.data[::self.loss_speed_factor,::self.loss_speed_factor], segments, counts)
+        segment_stats = segment_stats[:len(self.profR)*self.fft_segments].reshape(len(self.profR), self.fft_segments)
+        cbins = (np.arange(self.fft_segments) + 0.5) * 2 * np.pi / self.fft_segments
+        for i in np.nonzero(np.any(~np.isfinite(segment_stats), axis = 1))[0]:
+            N = np.isfinite(segment_stats[i])
+            if np.any(N):
+                segment_stats[i][~N] = np.interp(cbins[~N], cbins[N], segment_stats[i][N], period = 2*np.pi)
+
+        # Second Fourier mode of every ring at once
+        coefs = np.fft.rfft(segment_stats, axis = 1)
+        self.loss["radial fft2"] = np.where(self.profR < self.fft_start, temp_loss, np.abs(coefs[:,2]) * reg)
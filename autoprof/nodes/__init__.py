@@ -4,7 +4,7 @@ from .initialize_models import Initialize_Models
 from .sample_models import Sample_Models
 from .loss_image import Loss_Image
 from .compute_loss import Compute_Loss
-from .update_parameters import Update_Parameters_Random_Grad
+from .update_parameters import Update_Parameters_Random_Grad, Update_Parameters_Linear, Update_Parameters_LM, Update_Parameters_CMAES, Update_Parameters_Adam
 from .stop_iteration import Stop_Iteration
 from .save_models import Save_Models
 from .diagnostic_plots import Plot_Model, Plot_Loss_History
@@ -12,6 +12,8 @@ from .psf_model import Gaussian_PSF
 from .lock_models import Lock_Models
 from .psf_apply import Global_PSF
 from .variance_image import Variance_Image
+from .size_windows import Size_Model_Windows
+from .stochastic_loss import Stochastic_Loss
 # from .gaussian_psf import gaussian_psf
 # from .project_to_image import project_to_image
 # from .psf_image import psf_image
@@ -13,9 +13,10 @@ class Plot_Model(Process):
 
     def action(self, state):
         autocmap.set_under("k", alpha=0)
-        plt.figure(figsize = (7, 7*state.data.model_image.shape[1]/state.data.model_image.shape[0]))
+        model_image = state.data.materialize_model_image()
+        plt.figure(figsize = (7, 7*model_image.shape[1]/model_image.shape[0]))
         plt.imshow(
-            state.data.model_image.data,
+            model_image.data,
             origin="lower",
             cmap=autocmap,
             norm=ImageNormalize(stretch=LogStretch(), clip=False),
@@ -34,8 +35,8 @@ class Plot_Model(Process):
         )
         plt.close()
 
-        residual = (state.data.target - state.data.model_image).data
-        plt.figure(figsize = (7, 7*state.data.model_image.shape[1]/state.data.model_image.shape[0]))
+        residual = (state.data.target - model_image).data
+        plt.figure(figsize = (7, 7*model_image.shape[1]/model_image.shape[0]))
         plt.imshow(
             residual,
             origin="lower",
@@ -67,11 +68,13 @@ class Plot_Loss_History(Process):
     def action(self, state):
 
         for model in state.models:
-            if len(model.loss_history) == 0:
+            if model.history.steps == 0:
                 continue
-            for loss_quality in model.loss_history[0]:
-                if isinstance(model.loss_history[0][loss_quality],float):
-                    plt.plot(list(reversed(range(len(model.loss_history)))), np.log10(np.array(list(ml[loss_quality] for ml in model.loss_history)) / model.loss_history[-1][loss_quality]), label = f"{model.name}:{loss_quality}")
+            for loss_quality in model.history.loss_qualities:
+                if np.ndim(model.history.get_loss(loss_quality = loss_quality)) > 0:
+                    continue
+                loss = model.history.loss_series(loss_quality)
+                plt.plot(np.arange(len(loss)), np.log10(loss / loss[0]), label = f"{model.name}:{loss_quality}")
         plt.legend()
         plt.savefig(
             os.path.join(
@@ -9,7 +9,8 @@ class Initialize_Models(Process):
     def action(self, state):
         state.data.initialize_model_image()
         for model in state.models:
-            model.initialize(state.data.target - state.data.model_image)
-            model.sample_model()
-            state.data.model_image += model.model_image
+            model.initialize(state.data.subtract_offsets(state.data.target - state.data.model_image))
+            if not model.constant_offset:
+                model.sample_model()
+            state.data.add_model(model)
         return state
@@ -9,7 +9,7 @@ class Lock_Models(Process):
     def action(self, state):
 
         for model in state.models:
-            if len(model.loss_history) < 200:
+            if model.history.steps < 200:
                 continue
 
             # if not model.locked and model.iteration == state.models.iteration and np.std(model.loss_history[:100]) < (np.min(model.loss_history[:100])/1e3):
@@ -5,14 +5,22 @@ import numpy as np
 
 class Loss_Image(Process):
     """
-    Compute a loss image by comparing the data image and model image
+    Compute the residual between the data image and model image. The Chi^2 loss image itself is
+    only filled in if something asks for it (see Data_State.loss_image), or to build summed area
+    tables for the window losses when many models overlap.
     """
 
     def action(self, state):
 
-        target_area = state.data.target[state.data.model_image.window]
-        state.data.residual_image = target_area - state.data.model_image
-        state.data.loss_image = target_area.blank_copy()
-        state.data.loss_image.data = state.data.residual_image.data**2 / state.data.variance_image[state.data.model_image.window].data
+        # The residual is kept up to date by Sample_Models when the composite is updated in place
+        if state.data.residual_image is None:
+            state.data.update_residual()
+
+        # When the model windows overlap heavily, sum each pixel once into summed area tables
+        # rather than reading it again for every window
+        overlap = state.options["ap_loss_table_overlap", 2.]
+        window_area = sum(np.prod(model.window.shape) for model in state.models if not model.locked)
+        if window_area > overlap * np.prod(state.data.model_image.window.shape):
+            state.data.build_loss_table()
 
         return state
@@ -10,5 +10,7 @@ class Global_PSF(Process):
     def action(self, state):
 
         state.data.model_image.data = fft_convolve(state.data.model_image.data, state.data.psf.data)
+        # The composite no longer holds the model images that were added to it
+        state.data.model_convolved = True
 
         return state
@@ -2,18 +2,37 @@ from flow import Process
 
 class Sample_Models(Process):
     """
-    Create a model image based on the current set of model parameters.
+    Create a model image based on the current set of model parameters. The composite model image
+    is kept between iterations and only the models which have changed are replaced in it.
     """
 
     def action(self, state):
-        state.data.initialize_model_image()
+
+        # Flag the render stages which depend on changed parameters. Models which changed are
+        # taken out of the composite before they are rendered again, with a periodic rebuild to
+        # clear any rounding drift
+        changed = list(model for model in state.models if model.check_updates())
+        period = state.options["ap_sample_models_rebuild_period", 100]
+        incremental = state.data.can_update_model_image(changed) and state.models.iteration % period != 0
+        if incremental:
+            for model in changed:
+                state.data.remove_model(model)
+        
         state.models.sample_models()
         state.models.integrate_models()
         state.models.convolve_psf()
         state.models.add_integrated_models()
+        state.models.shift_models()
+        state.models.rescale_models()
 
+        if incremental:
+            for model in changed:
+                state.data.add_model(model)
+            return state
+
+        state.data.initialize_model_image()
         for model in state.models:
-            state.data.model_image += model.model_image
+            state.data.add_model(model)
             
         return state
 
@@ -32,6 +51,8 @@ class Sample_Expanded_Models(Process):
             model.integrate_model()
             model.convolve_psf()
             model.add_integrated_model()
+            model.shift_center()
+            model.rescale_amplitude()
 
         full_target = state.options["ap_sample_expanded_models_fulltarget", False]
         include_locked = state.options["ap_sample_expanded_models_includelocked", False]
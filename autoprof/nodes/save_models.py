@@ -11,7 +11,7 @@ class Save_Models(Process):
         print("saving models")
         state.models.save_models()
         header = fits.Header()
-        hdul = fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(state.data.model_image.data)])
+        hdul = fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(state.data.materialize_model_image().data)])
         hdul.writeto(
             os.path.join(state.options.save_path, state.options.name + '_model.fits'),
             overwrite=True,
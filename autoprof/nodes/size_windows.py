@@ -0,0 +1,49 @@
+from flow import Process
+import numpy as np
+import logging
+
+class Size_Model_Windows(Process):
+    """
+    Resize each model window to the radius where the model surface brightness drops below a
+    fraction of the local noise, plus the PSF FWHM to allow for convolution. Runs once after the
+    models are initialized and then every few iterations of the fit loop, windows are only
+    changed when the required size differs from the current one by more than a tolerance. The
+    loss history of a resized model is rebaselined, since earlier losses covered other pixels.
+    Not part of the default pipeline, add it before the fit loop and inside it with the options:
+    ap_pipeline_insert_steps = [("fit_loop", "Size_Model_Windows")]
+    ap_pipeline_fitloop_insert_steps = [("Sample_Models", "Size_Model_Windows")]
+    """
+
+    def action(self, state):
+
+        # The first sizing happens before the fit loop, so skip the first iteration inside it
+        period = state.options["ap_size_windows_period", 50]
+        if state.models.iteration >= 0 and (state.models.iteration == 0 or state.models.iteration % period != 0):
+            return state
+        noise_fraction = state.options["ap_size_windows_noise_fraction", 0.1]
+        tolerance = state.options["ap_size_windows_tolerance", 0.2]
+        psf_size = 0. if state.data.psf is None else state.data.psf.fwhm
+
+        for model in state.models:
+            if model.locked:
+                continue
+            # Local noise per pixel in the current window
+            if state.data.variance_image is not None:
+                noise = np.sqrt(np.median(state.data.variance_image[model.window].data))
+            elif model.noise_level:
+                noise = model.noise_level * state.data.target.pixelscale**2
+            else:
+                continue
+            radius = model.window_radius(noise_fraction * noise)
+            if radius is None:
+                continue
+            radius += psf_size
+            current = np.max(model.window.shape) / 2
+            if np.abs(radius - current) <= tolerance * current:
+                continue
+            logging.info(f"resizing window: {model.name}, {current} -> {radius}")
+            model.center_window(radius)
+            # Losses from the old window were measured on different pixels
+            model.history.rebaseline()
+
+        return state
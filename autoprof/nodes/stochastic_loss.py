@@ -0,0 +1,105 @@
+from flow import Process
+from autoprof.utils.sampling import importance_cdf, importance_sample
+from .sample_models import Sample_Models
+from .loss_image import Loss_Image
+from .compute_loss import Compute_Loss
+import numpy as np
+
+class Stochastic_Loss(Process):
+    """
+    Estimate the loss of each model from a random subset of the pixels in its window, evaluating
+    the models only at those pixels instead of rendering the model image. Pixels are drawn with
+    probability weighted by the last rendered model flux and reweighted so the mean Chi^2 is
+    unbiased. The sample for a model doubles once its estimated loss stops improving, meaning no
+    estimate has beaten the best one at the current sample size by more than
+    "ap_stochastic_loss_significance" standard errors for "ap_stochastic_loss_patience"
+    iterations. Once the sample reaches half of a model window, or if any model can't be
+    evaluated pixel by pixel, the full Sample_Models, Loss_Image and Compute_Loss steps are run
+    instead. Use in place of those three steps in the fit loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.proposals = {}
+        # Sample size of each model, with the best estimate at that size and the number of
+        # iterations since it last improved
+        self.samples = {}
+        self.full_nodes = (Sample_Models(), Loss_Image(), Compute_Loss())
+
+    def full_loss(self, state):
+        for node in self.full_nodes:
+            state = node.action(state)
+        return state
+
+    def update_sample(self, sample, loss, error, significance, patience):
+        """
+        Record a loss estimate with its standard error, doubling the sample size once the
+        estimates stop improving by more than their noise.
+        """
+        if sample["best"] - loss > significance * error:
+            sample["best"] = loss
+            sample["stale"] = 0
+            return
+        sample["stale"] += 1
+        if sample["stale"] >= patience:
+            sample["N"] *= 2
+            sample["best"] = np.inf
+            sample["stale"] = 0
+
+    def action(self, state):
+
+        # Only the global loss can be estimated from scattered pixels
+        if any(len(model.history.map_loss_quality) > 1 for model in state.models):
+            return self.full_loss(state)
+
+        pixels = state.options["ap_stochastic_loss_pixels", 1000]
+        patience = state.options["ap_stochastic_loss_patience", 10]
+        significance = state.options["ap_stochastic_loss_significance", 2.]
+        uniform = state.options["ap_stochastic_loss_uniform", 0.5]
+        target = state.data.target
+        # Models_State is its own iterator, so take a list for the nested loops below
+        models = list(state.models)
+        indices = dict((model.name, model.window.get_indices(target)) for model in models)
+
+        losses = {}
+        for model in models:
+            if model.locked:
+                continue
+            rows, cols = indices[model.name]
+            shape = (rows.stop - rows.start, cols.stop - cols.start)
+            sample = self.samples.setdefault(model.name, {"N": pixels, "best": np.inf, "stale": 0})
+            N = int(min(np.prod(shape), sample["N"]))
+
+            # Once the sample approaches the window size, rendering the models is cheaper
+            if N >= np.prod(shape) / 2:
+                return self.full_loss(state)
+            # Draw pixels weighted by the model flux from the last render, the distribution is
+            # rebuilt whenever the sample size doubles
+            key = (shape, N)
+            if self.proposals.get(model.name, (None,))[0] != key:
+                weights = model.model_image.data if model.model_image is not None and model.model_image.data.shape == shape else np.ones(shape)
+                self.proposals[model.name] = (key, importance_cdf(weights, uniform))
+            index, factor = importance_sample(self.proposals[model.name][1], N)
+            I = index // shape[1] + rows.start
+            J = index % shape[1] + cols.start
+
+            # Sum every model which covers the drawn pixels
+            flux = np.zeros(len(I))
+            for other in models:
+                other_rows, other_cols = indices[other.name]
+                inside = (I >= other_rows.start) & (I < other_rows.stop) & (J >= other_cols.start) & (J < other_cols.stop)
+                if not np.any(inside):
+                    continue
+                sample = other.sample_pixels(I[inside], J[inside], target)
+                if sample is None:
+                    return self.full_loss(state)
+                flux[inside] += sample
+
+            loss = factor * (target.data[I, J] - flux)**2 * state.data.inverse_variance.data[I, J]
+            losses[model.name] = (np.mean(loss), np.std(loss) / np.sqrt(N))
+
+        for model in models:
+            if model.name in losses:
+                model.loss = {"global": losses[model.name][0]}
+                self.update_sample(self.samples[model.name], *losses[model.name], significance, patience)
+        return state
@@ -1,5 +1,11 @@
 from flow import Process
 from autoprof.utils.optimization import k_delta_step
+from autoprof.utils.sampling import importance_cdf, importance_sample
+from autoprof.image import AP_Image
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 import numpy as np
 
 class Update_Parameters_Random_Grad(Process):
@@ -9,16 +15,72 @@ class Update_Parameters_Random_Grad(Process):
     Stocastic kdelta operates by computing the gradient on the hyperplane defined by "k" samples of the loss function. A
     stocastic update is included to ensure the full parameter space can be explored even when k is less than dimensions
     plus one.
+    Proposals for the global loss can be screened on a cheap proxy before being accepted, see
+    screen_proposals.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.loss_scheduler = {}
+        self.screen_cdf = {}
+
+    def screen_proposals(self, state, model, indices, current, candidates):
+        """
+        Choose between candidate parameter representations using a cheap proxy for the change in
+        the global loss. The Chi^2 is estimated on a sample of pixels from the model window, with
+        the model evaluated pointwise (ignoring PSF convolution and integration) and everything
+        else taken from the current residual image. The first candidate which is not worse than
+        the current parameters by more than "ap_screen_proposals_sigma" standard errors, paired
+        over the same pixels, is returned, otherwise the candidate with the lowest proxy loss.
+        Returns the first candidate if the proxy can't be evaluated.
+        """
+        data = state.data
+        if data.residual_image is None or data.inverse_variance is None or model.locked:
+            return candidates[0]
+        rows, cols = model.window.get_indices(data.residual_image)
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        if shape[0] <= 0 or shape[1] <= 0:
+            return candidates[0]
+
+        # Draw pixels weighted by the model flux, so the proxy focuses where the model matters. The
+        # distribution only needs to be rough, so it is rebuilt every few iterations
+        key = (shape, model.iteration // 16)
+        if self.screen_cdf.get(model.name, (None,))[0] != key:
+            weights = model.model_image.data if model.model_image is not None and model.model_image.data.shape == shape else np.ones(shape)
+            self.screen_cdf[model.name] = (key, importance_cdf(weights))
+        index, factor = importance_sample(self.screen_cdf[model.name][1], state.options["ap_screen_proposals_pixels", 500])
+        I = index // shape[1] + rows.start
+        J = index % shape[1] + cols.start
+
+        # The residual already includes the model at its current parameters
+        base = model.sample_pixels(I, J, data.residual_image, proxy = True)
+        if base is None:
+            return candidates[0]
+        others = data.residual_image.data[I, J] + base
+        weight = data.inverse_variance[data.model_image.window].data[I, J]
+
+        vector = model.parameter_vector
+        def proxy_loss(representation):
+            vector.set_representation(representation, indices)
+            return (others - model.sample_pixels(I, J, data.residual_image, proxy = True))**2 * weight
+
+        sigma = state.options["ap_screen_proposals_sigma", 2.]
+        reference = proxy_loss(current)
+        best, best_delta = 0, np.inf
+        for i, candidate in enumerate(candidates):
+            diff = factor * (proxy_loss(candidate) - reference)
+            delta = np.mean(diff)
+            if delta <= sigma * np.std(diff) / np.sqrt(len(diff)):
+                return candidate
+            if delta < best_delta:
+                best, best_delta = i, delta
+        return candidates[best]
     
     def action(self, state):
 
         N_uncertainty = 16
         N_lim = 4
+        N_screen = state.options["ap_screen_proposals", 4]
         state.models.step_iteration()
         # Loop through each model
         for model in state.models:
@@ -52,38 +114,48 @@ class Update_Parameters_Random_Grad(Process):
                 if key.split(" ")[0] == run_loss:
                     run_losses.append(key)
                 
-            for loss, params in list(loss_history[key] for key in run_losses):
+            vector = model.parameter_vector
+            linear = state.models.linear_parameters.get(model.name, None)
+            for key in run_losses:
+                loss, indices, reps = loss_history[key]
+                # Amplitudes solved by Update_Parameters_Linear are left to it
+                if linear is not None:
+                    keep = ~np.isin(indices, vector.index([linear]))
+                    indices, reps = indices[keep], reps[:, keep]
                 # If all params are fixed, skip this optimization step
-                if len(params) == 0 or loss is None:
+                if len(indices) == 0 or len(loss) == 0:
                     continue
 
-                if uncertainty_update:
-                    for par in range(len(params[0])):
-                        reps = list(P[par].representation for P in params)
-                        if np.abs(np.mean(reps[:N_uncertainty//2]) - np.mean(reps[N_uncertainty//2:])) > (np.std(reps[:N_uncertainty//2])/np.sqrt(N_uncertainty//2)):
-                            print(f"uncertainty increase: {params[0][par].name}, {params[0][par].uncertainty}")
-                            params[0][par].uncertainty *= 1.1
-                        else:
-                            print(f"uncertainty decrease: {params[0][par].name}, {params[0][par].uncertainty}")
-                            params[0][par].uncertainty *= 0.7
+                # The history can be shorter after a rebaseline
+                if uncertainty_update and len(loss) >= N_uncertainty:
+                    half = N_uncertainty//2
+                    drift = np.abs(np.mean(reps[:half], axis = 0) - np.mean(reps[half:], axis = 0)) > (np.std(reps[:half], axis = 0)/np.sqrt(half))
+                    print(f"uncertainty increase: {list(np.array(vector.names)[indices[drift]])}, decrease: {list(np.array(vector.names)[indices[~drift]])}")
+                    vector.uncertainty[indices] *= np.where(drift, 1.1, 0.7)
                         
                 # Determine the perturbation scale
-                param_scale = np.array(list(par.uncertainty for par in params[0]))
+                param_scale = vector.get_uncertainty(indices)
 
-                # sample the random step
-                update = np.random.normal(scale = param_scale)
                 best = np.argmin(loss[:N_lim])
                 
                 # Compute the gradient step
+                update = np.zeros(len(indices))
                 if len(loss) >= N_lim:
-                    grad_step = np.require(k_delta_step(loss[:N_lim], params[:N_lim], k = N_lim - 1, reference = best),dtype=float)
+                    # Unwrap cyclic parameters around the best step so plain differences are used
+                    steps = reps[best] - vector.difference(reps[best], reps[:N_lim], indices)
+                    grad_step = np.require(k_delta_step(loss[:N_lim], steps, k = N_lim - 1, reference = best),dtype=float)
                     grad_norm = np.linalg.norm(grad_step)
                     if grad_norm > 1e-5:
                         update -= grad_step * model.learning_rate * np.linalg.norm(param_scale) / grad_norm
 
-                # Apply the update to each parameter
-                for i, P in enumerate(params[0]):
-                    model[P.name].set_representation(params[best][i].representation + update[i])
+                # sample the random step, global loss proposals are screened before the full evaluation
+                proposal = reps[best] + update + np.random.normal(scale = param_scale)
+                if key == "global" and N_screen > 1:
+                    candidates = [proposal] + list(reps[best] + update + np.random.normal(scale = param_scale) for _ in range(N_screen - 1))
+                    proposal = self.screen_proposals(state, model, indices, reps[best], candidates)
+
+                # Apply the update to all the parameters at once
+                vector.set_representation(proposal, indices)
         
         return state
 
@@ -119,3 +191,387 @@ class Update_Parameters_Random(Process):
                 
         
         return state
+
+class Update_Parameters_Linear(Process):
+    """
+    Solve for the linear amplitude parameters of all the models (such as I0 and sky) with an
+    exact weighted least squares fit to the target, given the current values of all the other
+    parameters. The solved amplitude parameters are recorded in state.models.linear_parameters
+    and left alone by Update_Parameters_Random_Grad, so the stochastic updates only need to
+    search the nonlinear parameters. Must be placed after Sample_Models and
+    before Loss_Image in the fit loop, for example with the option:
+    ap_pipeline_fitloop_insert_steps = [("Loss_Image", "Update_Parameters_Linear")]
+    """
+
+    def action(self, state):
+
+        # Collect the unit amplitude image for each model with a free amplitude
+        linear = []
+        state.models.linear_parameters = {}
+        for model in state.models:
+            if model.locked or model.amplitude_parameter is None or model[model.amplitude_parameter].user_fixed:
+                continue
+            amplitude = model[model.amplitude_parameter].value
+            if model.constant_offset:
+                unit = np.full(model.model_image.data.shape, state.data.target.pixelscale**2)
+            elif amplitude:
+                unit = model.model_image.data / amplitude
+            else:
+                # Zero amplitude images carry no information about the profile
+                continue
+            linear.append((model, amplitude, AP_Image(unit, pixelscale = model.model_image.pixelscale, origin = model.model_image.origin)))
+        if len(linear) == 0:
+            return state
+
+        # Weighted normal equations, using the current residual so models without amplitudes are accounted for
+        if state.data.residual_image is None:
+            state.data.update_residual()
+        residual = state.data.residual_image
+        weight = state.data.inverse_variance[state.data.model_image.window].data
+        G = np.zeros((len(linear), len(linear)))
+        b = np.zeros(len(linear))
+        for k, (model_k, amplitude_k, unit_k) in enumerate(linear):
+            indices = unit_k.window.get_indices(residual)
+            weighted = weight[indices] * unit_k.data[residual.window.get_indices(unit_k)]
+            b[k] = np.sum(weighted * residual.data[indices])
+            for l in range(k, len(linear)):
+                unit_l = linear[l][2]
+                overlap = unit_k.window * unit_l.window
+                if np.any(overlap.shape <= 0):
+                    continue
+                G[k, l] = G[l, k] = np.sum(weight[overlap.get_indices(residual)] * unit_k.data[overlap.get_indices(unit_k)] * unit_l.data[overlap.get_indices(unit_l)])
+        amplitudes = np.array(list(L[1] for L in linear))
+        solution = np.linalg.lstsq(G, b + G @ amplitudes, rcond = None)[0]
+
+        # Update the models to the solved amplitudes, and replace them in the composite model
+        for (model, amplitude, unit), new_amplitude in zip(linear, solution):
+            state.data.remove_model(model)
+            model[model.amplitude_parameter].set_value(new_amplitude, override_fixed = True)
+            state.models.linear_parameters[model.name] = model.amplitude_parameter
+            model.check_updates()
+            model.rescale_amplitude()
+            state.data.add_model(model)
+
+        return state
+
+class Update_Parameters_LM(Process):
+    """
+    Levenberg-Marquardt updates of the model parameters. The Jacobian of the residual with
+    respect to the free parameter representations is built over each model window, from
+    analytic derivative images where the model has them and finite differences otherwise, and a
+    damped Gauss-Newton step is taken against the current residual. By default one joint step
+    is solved for all the unlocked models, so overlapping models are fit together. The normal
+    equations only couple models where their windows overlap, so they are assembled and solved
+    as a sparse system. With the option ap_lm_joint = False each model takes its own step. If
+    the loss has not improved by the next iteration the step is undone and a more strongly
+    damped step is solved from the stored normal equations, otherwise the damping is relaxed.
+    Use in place of Update_Parameters_Random_Grad in the fit loop, for example with the option:
+    ap_pipeline_fitloop_replace_steps = [("Update_Parameters_Random_Grad", "Update_Parameters_LM")]
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps = {}
+
+    def normal_equations(self, state, group):
+        """
+        Weighted normal equations J^T W J (as a sparse block matrix) and J^T W r for a group of
+        (model, indices) pairs, where J is the Jacobian of the model images and r the current
+        residual. Blocks are only filled where the model windows overlap.
+        """
+        residual = state.data.residual_image
+        weight = state.data.inverse_variance[state.data.model_image.window].data
+        step = state.options["ap_lm_finite_difference_step", 1e-3]
+        jacobians = list(model.jacobian(indices, step = step, psf = state.data.psf) for model, indices in group)
+        blocks = list([None] * len(group) for _ in group)
+        b = []
+        for k, (model_k, indices_k) in enumerate(group):
+            window = model_k.model_image.window.get_indices(residual)
+            jacobian = jacobians[k][(slice(None),) + residual.window.get_indices(model_k.model_image)].reshape(len(indices_k), -1)
+            b.append((jacobian * weight[window].reshape(1, -1)) @ residual.data[window].ravel())
+            for l in range(k, len(group)):
+                model_l, indices_l = group[l]
+                overlap = model_k.model_image.window * model_l.model_image.window * residual.window
+                if np.any(overlap.shape <= 0) and k != l:
+                    continue
+                J_k = jacobians[k][(slice(None),) + overlap.get_indices(model_k.model_image)].reshape(len(indices_k), -1)
+                J_l = jacobians[l][(slice(None),) + overlap.get_indices(model_l.model_image)].reshape(len(indices_l), -1)
+                blocks[k][l] = sparse.csr_matrix((J_k * weight[overlap.get_indices(residual)].reshape(1, -1)) @ J_l.T)
+                blocks[l][k] = blocks[k][l].T
+        return sparse.bmat(blocks, format = "csc"), np.concatenate(b)
+
+    def solve(self, A, b, damping):
+        """
+        Damped step with Marquardt scaling, elements which don't affect the images are left alone.
+        """
+        diagonal = A.diagonal()
+        active = np.nonzero(diagonal > 0)[0]
+        update = np.zeros(len(b))
+        damped = A[active][:, active] + sparse.diags(damping * diagonal[active])
+        update[active] = spsolve(damped.tocsc(), b[active])
+        return update
+
+    def action(self, state):
+
+        # Loss at the current parameters, before it is moved into the history
+        models = list(state.models)
+        evaluated = set(model.name for model in models if model.loss is not None)
+        state.models.step_iteration()
+        if len(evaluated) == 0:
+            return state
+        if state.data.residual_image is None:
+            state.data.update_residual()
+
+        group = []
+        for model in models:
+            if model.locked or model.name not in evaluated:
+                continue
+            indices = np.nonzero(~model.parameter_vector.fixed)[0]
+            if len(indices) > 0:
+                group.append((model, indices))
+        groups = [group] if state.options["ap_lm_joint", True] else list([entry] for entry in group)
+
+        damping = state.options["ap_lm_damping", 1e-3]
+        factor = state.options["ap_lm_damping_factor", 10.]
+        for group in groups:
+            if len(group) == 0:
+                continue
+            key = tuple(model.name for model, indices in group)
+            window = group[0][0].window
+            for model, indices in group[1:]:
+                window = window + model.window
+            loss = state.data.window_loss(window)
+
+            step = self.steps.get(key, None)
+            if step is not None and all(np.array_equal(I, indices) for I, (model, indices) in zip(step["indices"], group)) and loss > step["loss"]:
+                # The last step made things worse, go back and take a smaller one
+                step["damping"] *= factor
+                for values, (model, indices) in zip(step["values"], group):
+                    model.parameter_vector.set_values(values, indices)
+            else:
+                A, b = self.normal_equations(state, group)
+                step = {
+                    "indices": list(indices for model, indices in group),
+                    "values": list(model.parameter_vector.get_values(indices) for model, indices in group),
+                    "loss": loss,
+                    "A": A,
+                    "b": b,
+                    "damping": damping if step is None else max(step["damping"] / factor, 1e-12),
+                }
+                self.steps[key] = step
+
+            update = self.solve(step["A"], step["b"], step["damping"])
+            start = 0
+            for model, indices in group:
+                vector = model.parameter_vector
+                vector.set_representation(vector.get_representation(indices) + update[start:start + len(indices)], indices)
+                start += len(indices)
+
+        return state
+
+class Update_Parameters_CMAES(Process):
+    """
+    Covariance matrix adaptation evolution strategy updates of the model parameters. Each
+    iteration is one generation: for every model a population of proposals is drawn around the
+    current mean in parameter representation space, each proposal is rendered and scored
+    against the residual of the other models as one batch, and the mean, step size and full
+    covariance are adapted from the ranked results. The covariance starts from the parameter
+    uncertainties. Proposals are rendered with copies of the model, and the population can be
+    spread over a pool of threads with the option ap_cmaes_threads, each thread rendering with
+    its own copy. Use in place of
+    Update_Parameters_Random_Grad in the fit loop, for example with the option:
+    ap_pipeline_fitloop_replace_steps = [("Update_Parameters_Random_Grad", "Update_Parameters_CMAES")]
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.strategies = {}
+        self.workers = {}
+
+    def new_strategy(self, state, model, indices):
+        N = len(indices)
+        population = state.options["ap_cmaes_population", 4 + int(3 * np.log(N))]
+        mu = population // 2
+        weights = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+        weights /= np.sum(weights)
+        mueff = 1 / np.sum(weights**2)
+        c1 = 2 / ((N + 1.3)**2 + mueff)
+        scale = model.parameter_vector.get_uncertainty(indices)
+        scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.)
+        return {
+            "indices": indices,
+            "population": population,
+            "weights": weights,
+            "mueff": mueff,
+            "cc": (4 + mueff / N) / (N + 4 + 2 * mueff / N),
+            "cs": (mueff + 2) / (N + mueff + 5),
+            "c1": c1,
+            "cmu": min(1 - c1, 2 * (mueff - 2 + 1 / mueff) / ((N + 2)**2 + mueff)),
+            "ds": 1 + 2 * max(0, np.sqrt((mueff - 1) / (N + 1)) - 1) + (mueff + 2) / (N + mueff + 5),
+            "chiN": np.sqrt(N) * (1 - 1 / (4 * N) + 1 / (21 * N**2)),
+            "mean": model.parameter_vector.get_representation(indices),
+            "sigma": 1.,
+            "C": np.diag(scale**2),
+            "ps": np.zeros(N),
+            "pc": np.zeros(N),
+            "generation": 0,
+        }
+
+    def score(self, state, model, indices, population):
+        """
+        Mean Chi^2 over the model window for each proposal in the population, with the other
+        models taken from the current residual image.
+        """
+        residual = state.data.residual_image
+        window = model.model_image.window * residual.window
+        # The residual already has the model subtracted at its current parameters
+        target = np.copy(residual[window].data)
+        if model.constant_offset:
+            target += model.model_offset()
+        else:
+            target += model.model_image[window].data
+        weight = state.data.inverse_variance[window].data
+        sample_indices = window.get_indices(model.model_image)
+        psf = state.data.psf
+
+        def evaluate(worker, proposals):
+            losses = []
+            for proposal in proposals:
+                worker.parameter_vector.set_representation(proposal, indices, override_fixed = True)
+                sample_image = model.model_image.blank_copy()
+                worker.sample_model(sample_image)
+                # Proposals are convolved like the model image in the residual
+                if psf is not None and "none" not in worker.psf_mode:
+                    worker.convolve_image(sample_image, psf)
+                losses.append(np.mean(weight * (target - sample_image.data[sample_indices])**2))
+            return losses
+
+        # Proposals are rendered with copies of the model, sharing the target and history, so the
+        # parameters and render state of the model itself are never touched
+        threads = max(1, state.options["ap_cmaes_threads", 1])
+        workers = self.workers.get(model.name, [])
+        while len(workers) < threads:
+            workers.append(deepcopy(model, {id(model.target): model.target, id(model.history): model.history}))
+        self.workers[model.name] = workers
+        for worker in workers[:threads]:
+            worker.parameter_vector.set_values(model.parameter_vector.get_values(), override_fixed = True)
+        if threads == 1:
+            return np.array(evaluate(workers[0], population))
+        chunks = np.array_split(np.arange(len(population)), threads)
+        with ThreadPoolExecutor(max_workers = threads) as pool:
+            results = list(pool.map(lambda args: evaluate(args[0], population[args[1]]), zip(workers, chunks)))
+        return np.concatenate(results)
+
+    def action(self, state):
+
+        models = list(state.models)
+        evaluated = set(model.name for model in models if model.loss is not None)
+        state.models.step_iteration()
+        if len(evaluated) == 0:
+            return state
+        if state.data.residual_image is None:
+            state.data.update_residual()
+
+        for model in models:
+            if model.locked or model.name not in evaluated:
+                continue
+            vector = model.parameter_vector
+            indices = np.nonzero(~vector.fixed)[0]
+            if len(indices) == 0:
+                continue
+            S = self.strategies.get(model.name, None)
+            if S is None or not np.array_equal(S["indices"], indices):
+                S = self.new_strategy(state, model, indices)
+                self.strategies[model.name] = S
+            N = len(indices)
+
+            # Sample the population from the current search distribution
+            eigenvalues, B = np.linalg.eigh(S["C"])
+            D = np.sqrt(np.maximum(eigenvalues, 1e-20))
+            Z = np.random.normal(size = (S["population"], N))
+            Y = (Z * D) @ B.T
+            population = S["mean"] + S["sigma"] * Y
+            losses = self.score(state, model, indices, population)
+
+            # Recombine the best half and adapt the evolution paths, covariance and step size
+            order = np.argsort(losses)[:len(S["weights"])]
+            step = S["weights"] @ Y[order]
+            S["mean"] = S["mean"] + S["sigma"] * step
+            S["generation"] += 1
+            S["ps"] = (1 - S["cs"]) * S["ps"] + np.sqrt(S["cs"] * (2 - S["cs"]) * S["mueff"]) * (B @ ((B.T @ step) / D))
+            hsig = np.linalg.norm(S["ps"]) / np.sqrt(1 - (1 - S["cs"])**(2 * S["generation"])) < (1.4 + 2 / (N + 1)) * S["chiN"]
+            S["pc"] = (1 - S["cc"]) * S["pc"] + hsig * np.sqrt(S["cc"] * (2 - S["cc"]) * S["mueff"]) * step
+            rank_mu = (Y[order].T * S["weights"]) @ Y[order]
+            S["C"] = (1 - S["c1"] - S["cmu"]) * S["C"] + S["c1"] * (np.outer(S["pc"], S["pc"]) + (1 - hsig) * S["cc"] * (2 - S["cc"]) * S["C"]) + S["cmu"] * rank_mu
+            S["sigma"] *= np.exp((S["cs"] / S["ds"]) * (np.linalg.norm(S["ps"]) / S["chiN"] - 1))
+
+            vector.set_representation(S["mean"], indices)
+        return state
+
+class Update_Parameters_Adam(Process):
+    """
+    Adam updates of the model parameters. The gradient of each model's loss (the mean Chi^2 in
+    its window) with respect to its free parameter representations is computed from the model
+    Jacobian, analytic where available and finite differences otherwise. Running estimates of
+    the first and second moments of the gradient are kept for every element of the parameter
+    vector, and each step is the bias corrected ratio of the two scaled by the model learning
+    rate and the parameter uncertainty. Locked models and fixed parameters are not updated and
+    keep their moments. The learning rate follows model.learning_rate_schedule when one is set.
+    Use in place of Update_Parameters_Random_Grad in the fit loop, for example with the option:
+    ap_pipeline_fitloop_replace_steps = [("Update_Parameters_Random_Grad", "Update_Parameters_Adam")]
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.moments = {}
+
+    def gradient(self, state, model, indices):
+        """
+        Gradient of the mean Chi^2 over the model window with respect to the representations of
+        the parameter vector elements at indices.
+        """
+        residual = state.data.residual_image
+        window = model.model_image.window * residual.window
+        jacobian = model.jacobian(indices, step = state.options["ap_adam_finite_difference_step", 1e-3], psf = state.data.psf)
+        jacobian = jacobian[(slice(None),) + window.get_indices(model.model_image)].reshape(len(indices), -1)
+        weighted = (state.data.inverse_variance[window].data * residual[window].data).ravel()
+        return -2 * (jacobian @ weighted) / len(weighted)
+
+    def action(self, state):
+
+        models = list(state.models)
+        evaluated = set(model.name for model in models if model.loss is not None)
+        state.models.step_iteration()
+        if len(evaluated) == 0:
+            return state
+        if state.data.residual_image is None:
+            state.data.update_residual()
+
+        beta1 = state.options["ap_adam_beta1", 0.9]
+        beta2 = state.options["ap_adam_beta2", 0.999]
+        epsilon = state.options["ap_adam_epsilon", 1e-8]
+        for model in models:
+            if model.locked or model.name not in evaluated:
+                continue
+            vector = model.parameter_vector
+            indices = np.nonzero(~vector.fixed)[0]
+            if len(indices) == 0:
+                continue
+            # Moments for every element of the vector, so fixing a parameter doesn't lose the others
+            if model.name not in self.moments or len(self.moments[model.name]["m"]) != len(vector):
+                self.moments[model.name] = {"m": np.zeros(len(vector)), "v": np.zeros(len(vector)), "t": np.zeros(len(vector), dtype = int)}
+            M = self.moments[model.name]
+
+            gradient = self.gradient(state, model, indices)
+            M["t"][indices] += 1
+            M["m"][indices] = beta1 * M["m"][indices] + (1 - beta1) * gradient
+            M["v"][indices] = beta2 * M["v"][indices] + (1 - beta2) * gradient**2
+            m_hat = M["m"][indices] / (1 - beta1**M["t"][indices])
+            v_hat = M["v"][indices] / (1 - beta2**M["t"][indices])
+
+            rate = model.learning_rate if model.learning_rate_schedule is None else model.learning_rate_schedule(model.iteration)
+            scale = vector.get_uncertainty(indices)
+            scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.)
+            vector.set_representation(vector.get_representation(indices) - rate * scale * m_hat / (np.sqrt(v_hat) + epsilon), indices)
+
+        return state
@@ -1,5 +1,6 @@
 from .substate_object import SubState
 from autoprof.image import AP_Image, PSF_Image, Model_Image
+from autoprof.utils.agregate_pixel import weighted_square_sum, summed_area_table, window_sum
 from astropy.io import fits
 import numpy as np
 from copy import deepcopy
@@ -13,9 +14,22 @@ class Data_State(SubState):
         self.mask = None
         self.psf = None
         self.variance_image = None
-        self.loss_image = None
+        self.inverse_variance = None
+        self._loss_image = None
         self.residual_image = None
+        self._residual_buffer = None
+        # Summed area tables of Chi^2 and of the pixels which contribute to it, see build_loss_table
+        self._loss_table = None
+        self._count_table = None
         self.model_image = None
+        self.model_offsets = {}
+        # Window each model was added to the composite with, so it can be removed again
+        self.contributions = {}
+        # Windows where the residual changed since the loss image was filled in, None for everywhere
+        self.changed_windows = None
+        # Set once the whole composite has been convolved with the PSF, after which models can't be
+        # taken out of it or added back unconvolved
+        self.model_convolved = False
     
     def load(self, filename, pixelscale, **kwargs):
         if "image_type" in kwargs:
@@ -46,6 +60,12 @@ class Data_State(SubState):
             self.variance_image = self.load(img, **kwargs)
         elif isinstance(img, np.ndarray):
             self.variance_image = AP_Image(img, **kwargs)
+        # Chi^2 weights are computed once, rather than dividing by the variance every iteration
+        self.inverse_variance = AP_Image(
+            1. / self.variance_image.data,
+            pixelscale = self.variance_image.pixelscale,
+            origin = self.variance_image.origin,
+        )
             
     def update_mask(self, img, mode = 'or', **kwargs):
         if isinstance(img, AP_Image):
@@ -71,8 +91,32 @@ class Data_State(SubState):
         elif isinstance(img, np.ndarray):
             self.psf = PSF_Image(img, **kwargs)
 
+    def model_image_window(self, include_locked = False):
+        """
+        Union of the model windows, which is the extent of the composite model image.
+        """
+        new_window = None
+        for model in self.state.models:
+            if model.locked and not include_locked:
+                continue
+            if new_window is None:
+                new_window = deepcopy(model.window)
+            else:
+                new_window += model.window
+        return new_window
+
     def initialize_model_image(self, full_target = False, include_locked = False):
 
+        self.model_offsets = {}
+        self.contributions = {}
+        self.changed_windows = None
+        self.model_convolved = False
+        self._loss_table = None
+        # The residual array is kept so update_residual can reuse it
+        if self.residual_image is not None:
+            self._residual_buffer = self.residual_image
+        self.residual_image = None
+
         if full_target:
             self.model_image = Model_Image(
                 np.zeros(np.round(self.target.shape / self.target.pixelscale).astype(int)),
@@ -80,19 +124,158 @@ class Data_State(SubState):
                 window = self.target.window,
             )
             return
-        new_window = None
-        for model in self.state.models:
-            if model.locked and not include_locked:
-                continue
-            if new_window is None:
-                new_window = deepcopy(model.window)
-            else:
-                new_window += model.window
+        new_window = self.model_image_window(include_locked)
                 
         self.model_image = Model_Image(
             np.zeros(np.round(np.array(new_window.shape) / self.target.pixelscale).astype(int)),
             pixelscale=self.target.pixelscale,
             origin=new_window.origin,
         )
-        
-        
+
+    def can_update_model_image(self, changed, max_fraction = 0.5):
+        """
+        Check if the composite model image can be updated in place, by removing and adding back
+        only the changed models. This needs every model to still have the window it was added
+        with and the union of the windows to be unchanged, and the composite must not have been
+        convolved as a whole. When the changed models cover more than max_fraction of the
+        composite it is cheaper to rebuild it.
+        """
+        if self.model_image is None or self.model_convolved:
+            return False
+        for model in self.state.models:
+            window = self.contributions.get(model.name, None)
+            if window is None or not (np.all(window.origin == model.window.origin) and np.all(window.shape == model.window.shape)):
+                return False
+        window = self.model_image_window()
+        if not (np.all(window.origin == self.model_image.origin) and np.all(window.shape == self.model_image.shape)):
+            return False
+        return sum(np.prod(model.window.shape) for model in changed) <= max_fraction * np.prod(self.model_image.shape)
+
+    def add_model(self, model):
+        """
+        Add the current image of a model to the composite model image. Constant models are kept
+        as scalar offsets, which are applied when the residual is computed. If there is a
+        residual image it is updated along with the composite, so the loss only needs to be
+        recomputed in changed_windows.
+        """
+        if model.constant_offset:
+            self.model_offsets[model.name] = (deepcopy(model.window), model.model_offset())
+            if self.residual_image is not None:
+                self.subtract_offsets(self.residual_image, [model.name])
+        else:
+            self.model_image += model.model_image
+            if self.residual_image is not None:
+                self.residual_image -= model.model_image
+        self.contributions[model.name] = deepcopy(model.window)
+        self._record_change(model.window)
+
+    def remove_model(self, model):
+        """
+        Remove a model from the composite model image, this must be done before the model image
+        is rendered again so that the image still holds the contribution that was added.
+        """
+        if model.constant_offset:
+            window, value = self.model_offsets.pop(model.name)
+            if self.residual_image is not None:
+                self.residual_image.data[window.get_indices(self.residual_image)] += value
+        else:
+            self.model_image -= model.model_image
+            if self.residual_image is not None:
+                self.residual_image += model.model_image
+        del self.contributions[model.name]
+        self._record_change(model.window)
+
+    def _record_change(self, window):
+        self._loss_table = None
+        if self.changed_windows is None:
+            return
+        if any(np.all(window.origin == W.origin) and np.all(window.shape == W.shape) for W in self.changed_windows):
+            return
+        self.changed_windows.append(deepcopy(window))
+
+    def update_residual(self):
+        """
+        Compute the residual of the target and the composite model (with its offsets), reusing
+        the residual image from the last iteration when the composite has the same extent.
+        """
+        target_area = self.target[self.model_image.window]
+        buffer = self._residual_buffer
+        if buffer is None or buffer.data.shape != self.model_image.data.shape or np.any(buffer.origin != self.model_image.origin):
+            self.residual_image = target_area - self.model_image
+        else:
+            np.subtract(target_area.data, self.model_image.data, out = buffer.data)
+            self.residual_image = buffer
+        self._residual_buffer = self.residual_image
+        self.subtract_offsets(self.residual_image)
+        self.changed_windows = None
+        self._loss_table = None
+
+    def build_loss_table(self):
+        """
+        Build summed area tables of the loss image and of its finite pixels, after which every
+        window_loss is a four corner lookup. Worthwhile when many model windows overlap, since
+        each pixel is then only read once per iteration.
+        """
+        loss = self.loss_image.data
+        finite = np.isfinite(loss)
+        self._loss_table = summed_area_table(np.where(finite, loss, 0.))
+        self._count_table = summed_area_table(finite)
+
+    def window_loss(self, window, step = 1):
+        """
+        Mean Chi^2 of the residual in a window, optionally using only every "step" pixel. The
+        squared and weighted residual is summed in one pass without making a loss image, or read
+        from the summed area tables if they have been built for the current residual. Either way
+        non-finite pixels are left out and the mean is over the finite ones.
+        """
+        indices = window.get_indices(self.residual_image)
+        if self._loss_table is not None:
+            # The table gives the exact window mean at no extra cost, so step isn't needed
+            return window_sum(self._loss_table, indices) / window_sum(self._count_table, indices)
+        residual = self.residual_image.data[indices][::step,::step]
+        weight = self.inverse_variance[self.model_image.window].data[indices][::step,::step]
+        total, count = weighted_square_sum(residual, weight)
+        return total / count
+
+    @property
+    def loss_image(self):
+        """
+        Chi^2 of each pixel in the composite model image. This is only filled in when requested,
+        such as for radial losses or diagnostics, and then only where the residual has changed.
+        """
+        if self.residual_image is None:
+            return None
+        weight = self.inverse_variance[self.model_image.window].data
+        if self._loss_image is None or self._loss_image.data.shape != self.residual_image.data.shape or np.any(self._loss_image.origin != self.residual_image.origin):
+            self._loss_image = self.residual_image.blank_copy()
+            self.changed_windows = None
+        if self.changed_windows is None:
+            windows = [self.model_image.window]
+        else:
+            windows = self.changed_windows
+        for window in windows:
+            indices = window.get_indices(self._loss_image)
+            np.multiply(self.residual_image.data[indices], self.residual_image.data[indices], out = self._loss_image.data[indices])
+            self._loss_image.data[indices] *= weight[indices]
+        self.changed_windows = []
+        return self._loss_image
+
+    def subtract_offsets(self, image, names = None):
+        """
+        Subtract the model offsets (or only those of the named models) from an image in place,
+        returns the image.
+        """
+        for name in (self.model_offsets if names is None else names):
+            window, value = self.model_offsets[name]
+            image.data[window.get_indices(image)] -= value
+        return image
+
+    def materialize_model_image(self):
+        """
+        Return a copy of the model image with the model offsets filled in, for output.
+        """
+        model_image = self.model_image.blank_copy()
+        model_image += self.model_image
+        for window, value in self.model_offsets.values():
+            model_image.data[window.get_indices(model_image)] += value
+        return model_image
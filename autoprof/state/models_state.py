@@ -13,6 +13,9 @@ class Models_State(SubState):
         self.models = {}
         self.model_list = []
         self.iteration = -1
+        # Amplitude parameter of each model which Update_Parameters_Linear solves for exactly, the
+        # stochastic updates leave these alone
+        self.linear_parameters = {}
         
     def add_model(self, name, model, **kwargs):
         MODELS = all_subclasses(BaseModel)
@@ -48,7 +51,11 @@ class Models_State(SubState):
             self.models[m].compute_loss(self.state.data)
 
     def sample_models(self):
+        # Stages which depend on changed parameters are flagged by check_updates in Sample_Models
         for m in self.model_list:
+            # Constant models are applied as offsets and never rendered
+            if self.models[m].constant_offset:
+                continue
             # Don't bother resampling the model if nothing has been updated
             if self.models[m].is_sampled:
                 continue
@@ -65,12 +72,20 @@ class Models_State(SubState):
             # Don't bother convolving the model if nothing has been updated
             if self.models[m].is_convolved:
                 continue
-            self.models[m].convolve_psf()
+            self.models[m].convolve_psf(self.state.data.psf)
 
     def add_integrated_models(self):
         for m in self.model_list:
             self.models[m].add_integrated_model()
 
+    def shift_models(self):
+        for m in self.model_list:
+            self.models[m].shift_center()
+
+    def rescale_models(self):
+        for m in self.model_list:
+            self.models[m].rescale_amplitude()
+
     def step_iteration(self):
         self.iteration += 1
         print('Now on iteration: ', self.iteration)
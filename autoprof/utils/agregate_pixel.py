@@ -56,3 +56,63 @@ def Sigma_Clip_Upper(v, iterations=10, nsigma=5, method = "median"):
         lim = med + rng * nsigma
         i += 1
     return lim
+
+def segment_median(values, segments, counts):
+    """
+    Median of the values in each segment, where "segments" gives the segment index of each value
+    and "counts" the number of values in each segment (from np.bincount). Empty segments give nan.
+    Rather than sorting each segment separately, the values are sorted once with the segment index
+    as the leading part of the sort key, which groups the segments with their values in order.
+    """
+    values = np.asarray(values).ravel()
+    counts = np.asarray(counts)
+    low, high = np.min(values), np.max(values)
+    # Values are mapped into [0, 0.5] so they never cross into the next segment
+    scale = 0.5 / (high - low) if high > low else 0.
+    ordered = values[np.argsort(segments + (values - low) * scale)]
+    starts = np.cumsum(counts) - counts
+    lower = np.minimum(starts + np.maximum(counts - 1, 0) // 2, len(values) - 1)
+    upper = np.minimum(starts + counts // 2, len(values) - 1)
+    return np.where(counts > 0, (ordered[lower] + ordered[upper]) / 2, np.nan)
+
+def weighted_square_sum(values, weights, block = 65536):
+    """
+    Sum of weights * values**2 over the elements where it is finite, along with the number of
+    those elements. Evaluated as a single fused product over blocks of about "block" elements
+    (whole rows), so no full size temporary arrays are made and each block stays in cache. Only
+    blocks containing non-finite terms are masked element by element.
+    """
+    if values.size == 0:
+        return 0., 0
+    rows = max(1, block // max(1, values.shape[1]))
+    total = 0.
+    count = 0
+    for r in range(0, values.shape[0], rows):
+        V, W = values[r:r + rows], weights[r:r + rows]
+        subtotal = np.einsum("ij,ij,ij->", V, V, W)
+        if np.isfinite(subtotal):
+            total += subtotal
+            count += V.size
+            continue
+        terms = V * V * W
+        finite = np.isfinite(terms)
+        total += np.sum(terms[finite])
+        count += int(np.sum(finite))
+    return total, count
+
+def summed_area_table(image):
+    """
+    Integral image with a leading row and column of zeros, so that the sum over any rectangle of
+    the image can be read from four corners with window_sum.
+    """
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    np.cumsum(image, axis = 0, out = table[1:,1:])
+    np.cumsum(table[1:,1:], axis = 1, out = table[1:,1:])
+    return table
+
+def window_sum(table, indices):
+    """
+    Sum of the image over the (row slice, column slice) indices, from its summed_area_table.
+    """
+    rows, cols = indices
+    return table[rows.stop, cols.stop] - table[rows.start, cols.stop] - table[rows.stop, cols.start] + table[rows.start, cols.start]
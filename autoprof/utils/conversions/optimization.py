@@ -21,6 +21,17 @@ def inv_boundaries(val, limits):
         return (val + limits[0] + np.sqrt((val - limits[0])**2 + 4)) * 0.5
     return (np.arctan(val) + np.pi/2) * (limits[1] - limits[0]) / np.pi + limits[0]
 
+def d_inv_boundaries(val, limits):
+    """
+    derivative of inv_boundaries with respect to val
+    """
+    
+    if limits[0] is None:
+        return (1 - (val - limits[1]) / np.sqrt((val - limits[1])**2 + 4)) * 0.5
+    elif limits[1] is None:
+        return (1 + (val - limits[0]) / np.sqrt((val - limits[0])**2 + 4)) * 0.5
+    return (limits[1] - limits[0]) / (np.pi * (1 + val**2))
+
 def cyclic_boundaries(val, limits):
     return limits[0] + ((val - limits[0]) % (limits[1] - limits[0]))
 
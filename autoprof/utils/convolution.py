@@ -8,3 +8,14 @@ def direct_convolve(img, psf, mask = None):
 def fft_convolve(img, psf, mask = None):
 
     return convolve_fft(img, psf, mask = mask)
+
+def fft_shift(spectrum, di, dj, shape):
+    """
+    Shift an image by a (sub-pixel) amount di, dj along its two axes, given its real FFT
+    spectrum, by applying a phase ramp and transforming back. The shift is periodic so flux
+    shifted past one edge of the image reappears at the opposite edge.
+    """
+    ky = np.fft.fftfreq(shape[0]).reshape(-1, 1)
+    kx = np.fft.rfftfreq(shape[1]).reshape(1, -1)
+    ramp = np.exp(-2j * np.pi * (ky * di + kx * dj))
+    return np.fft.irfft2(spectrum * ramp, s = shape)
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.interpolate import CubicSpline
 
 def window_function(img, X, Y, func, window):
     pass
@@ -105,3 +106,82 @@ def nearest_neighbor(img, X, Y):
         np.clip(np.round(X).astype(int), a_min = 0, a_max = img.shape[1] - 1),
     ]
 
+def cubic_spline_coefficients(knots, values):
+    """
+    Compute the piecewise cubic coefficients for an interpolating spline through (knots, values).
+    This is the same curve as UnivariateSpline(knots, values, s = 0) but the coefficients are
+    returned so that they can be stored and evaluated quickly many times.
+    output: array with shape (4, len(knots) - 1, ...) of polynomial coefficients, highest order first
+    """
+    return CubicSpline(knots, values, bc_type = "not-a-knot").c
+
+def cubic_spline_evaluate(knots, coefs, X):
+    """
+    Evaluate a piecewise cubic at the points X using precomputed coefficients from
+    cubic_spline_coefficients. Points outside the knots take the boundary value (like ext = "const").
+    Several profiles sharing the same knots may be evaluated at once by stacking them along a final
+    axis of the values, in which case the output has that extra final axis.
+    """
+    X = np.clip(X, knots[0], knots[-1])
+    i = np.clip(np.searchsorted(knots, X, side = "right") - 1, 0, len(knots) - 2)
+    dX = (X - knots[i]).reshape(np.shape(X) + (1,) * (coefs.ndim - 2))
+    # Horner's method for the cubic in each segment
+    return ((coefs[0][i] * dX + coefs[1][i]) * dX + coefs[2][i]) * dX + coefs[3][i]
+
+def cubic_spline_derivative(knots, coefs, X):
+    """
+    Derivative with respect to X of the piecewise cubic evaluated by cubic_spline_evaluate. Points
+    outside the knots take the boundary value there, so their derivative is zero.
+    """
+    outside = (X < knots[0]) | (X > knots[-1])
+    X = np.clip(X, knots[0], knots[-1])
+    i = np.clip(np.searchsorted(knots, X, side = "right") - 1, 0, len(knots) - 2)
+    dX = (X - knots[i]).reshape(np.shape(X) + (1,) * (coefs.ndim - 2))
+    slope = (3 * coefs[0][i] * dX + 2 * coefs[1][i]) * dX + coefs[2][i]
+    slope[outside] = 0.
+    return slope
+
+def adaptive_profile_table(func, rmin, rmax, tolerance = 1e-4, initial_knots = 64, max_knots = 262144):
+    """
+    Tabulate a one dimensional profile func(R) between rmin and rmax for fast lookup. Knots are
+    evenly spaced in sqrt(R), which concentrates them where profiles are steep, so that a lookup
+    only needs arithmetic to find its segment. The number of knots is doubled until linear
+    interpolation between the knots matches the true profile at every interval midpoint to within
+    the relative tolerance. Errors are measured relative to the local profile value, with a small
+    floor set by the profile peak so that the faint outskirts do not demand unlimited knots.
+    returns: table to be used with profile_table_evaluate
+    """
+    umin = np.sqrt(rmin)
+    umax = np.sqrt(rmax)
+    N = initial_knots
+    while True:
+        U = np.linspace(umin, umax, N)
+        values = func(U**2)
+        if N >= max_knots:
+            break
+        # Compare the interpolation and the true profile half way between each knot
+        mid_values = func(((U[:-1] + U[1:]) / 2)**2)
+        error = np.abs((values[:-1] + values[1:]) / 2 - mid_values)
+        if np.all(error <= tolerance * (np.abs(mid_values) + 1e-6 * np.max(np.abs(values)))):
+            break
+        N = 2 * N - 1
+    return umin, 1 / (U[1] - U[0]), values[:-1], np.diff(values)
+
+def profile_table_evaluate(table, R):
+    """
+    Evaluate a profile table from adaptive_profile_table at the radii R. Radii outside the table
+    take the value at its nearest end, rather than being extrapolated.
+    """
+    umin, inv_step, values, slopes = table
+    T = np.sqrt(R)
+    T -= umin
+    T *= inv_step
+    i = T.astype(np.intp)
+    np.clip(i, 0, len(values) - 1, out = i)
+    T -= i
+    np.clip(T, 0., 1., out = T)
+    # Interpolate in place to avoid temporary arrays
+    res = np.take(slopes, i)
+    res *= T
+    res += np.take(values, i)
+    return res
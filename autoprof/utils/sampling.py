@@ -0,0 +1,146 @@
+import numpy as np
+
+def symmetric_sample(func, shape, center):
+    """
+    Sample a function which is point symmetric about center on a pixel grid, while evaluating it
+    directly on only about half of the pixels. When the center is aligned with the pixel grid
+    (on a pixel center or a pixel corner along each axis) every reflected pixel lands exactly on
+    another pixel, so the rows on the larger side of the center are evaluated with func and the
+    other rows are copied from their reflection through the center. Otherwise the reflected
+    points would fall between pixels, where interpolation errors can't be bounded for profiles
+    with kinks, so every pixel is evaluated directly.
+
+    func: function of pixel index arrays I, J (broadcastable) returning the values at those pixels
+    shape: shape of the pixel grid
+    center: (i, j) position of the symmetry center in pixel index units, where pixel centers are integers
+    """
+    ny, nx = shape
+    ci, cj = center
+    I = np.arange(ny).reshape(-1, 1)
+    J = np.arange(nx).reshape(1, -1)
+    if abs(2 * ci - np.round(2 * ci)) > 1e-9 or abs(2 * cj - np.round(2 * cj)) > 1e-9:
+        return func(I, J)
+
+    # Evaluate on the rows up to the center, by flipping the grid so that this is the larger side
+    if ci < (ny - 1) / 2:
+        flipped = symmetric_sample(lambda I, J: func(ny - 1 - I, J), shape, (ny - 1 - ci, cj))
+        return flipped[::-1]
+
+    out = np.empty(shape)
+    n_eval = min(ny, int(np.floor(ci + 1e-9)) + 1)
+    out[:n_eval] = func(I[:n_eval], J)
+    if n_eval == ny:
+        return out
+
+    # Pixel (i, j) reflects exactly onto (Ki - i, Kj - j)
+    Ki = int(np.round(2 * ci))
+    Kj = int(np.round(2 * cj))
+    i1 = min(ny, Ki + 1)
+    j0 = max(0, Kj - nx + 1)
+    j1 = min(nx, Kj + 1)
+
+    # Pixels whose reflection is off the grid are evaluated directly
+    if i1 < ny:
+        out[i1:] = func(I[i1:], J)
+    if i1 <= n_eval:
+        return out
+    if j1 <= j0:
+        out[n_eval:i1] = func(I[n_eval:i1], J)
+        return out
+    if j0 > 0:
+        out[n_eval:i1, :j0] = func(I[n_eval:i1], J[:, :j0])
+    if j1 < nx:
+        out[n_eval:i1, j1:] = func(I[n_eval:i1], J[:, j1:])
+    out[n_eval:i1, j0:j1] = out[Ki - i1 + 1 : Ki - n_eval + 1, Kj - j1 + 1 : Kj - j0 + 1][::-1, ::-1]
+    return out
+
+def coarse_sample(func, shape, step, tolerance):
+    """
+    Sample a smooth function on a pixel grid by evaluating it on a coarse grid of nodes every
+    "step" pixels and bilinearly interpolating between them. Each tile between four nodes is
+    checked by evaluating its central pixel, and tiles where the interpolation misses by more
+    than half the (absolute) tolerance are evaluated directly at every pixel, as are the
+    neighbours of every refined tile which turned out to miss. This way only regions with strong
+    curvature, such as the core of a galaxy or a kink in the profile, are evaluated at full
+    resolution.
+
+    func: function of pixel index arrays I, J (broadcastable) returning the values at those pixels
+    shape: shape of the pixel grid
+    step: spacing of the coarse grid in pixels
+    tolerance: maximum allowed interpolation error, in the same units as func
+    """
+    ny, nx = shape
+    nodes_i = np.unique(np.concatenate((np.arange(0, ny, step), [ny - 1])))
+    nodes_j = np.unique(np.concatenate((np.arange(0, nx, step), [nx - 1])))
+    coarse = func(nodes_i.reshape(-1, 1), nodes_j.reshape(1, -1))
+    if len(nodes_i) < 2 or len(nodes_j) < 2:
+        return func(np.arange(ny).reshape(-1, 1), np.arange(nx).reshape(1, -1))
+
+    # Tile each pixel belongs to and its fractional position between the nodes
+    tile_i = np.clip(np.searchsorted(nodes_i, np.arange(ny), side = "right") - 1, 0, len(nodes_i) - 2)
+    tile_j = np.clip(np.searchsorted(nodes_j, np.arange(nx), side = "right") - 1, 0, len(nodes_j) - 2)
+    frac_i = ((np.arange(ny) - nodes_i[tile_i]) / np.diff(nodes_i)[tile_i]).reshape(-1, 1)
+    frac_j = ((np.arange(nx) - nodes_j[tile_j]) / np.diff(nodes_j)[tile_j]).reshape(1, -1)
+
+    # Interpolate along the rows, then along the columns
+    rows = coarse[tile_i] * (1 - frac_i) + coarse[tile_i + 1] * frac_i
+    out = rows[:, tile_j]
+    out *= 1 - frac_j
+    out += rows[:, tile_j + 1] * frac_j
+
+    # Check the interpolation at the center pixel of every tile, with a margin since the center
+    # need not be the worst pixel
+    mid_i = (nodes_i[:-1] + nodes_i[1:]) // 2
+    mid_j = (nodes_j[:-1] + nodes_j[1:]) // 2
+    mid = func(mid_i.reshape(-1, 1), mid_j.reshape(1, -1))
+    refine = np.abs(mid - out[np.ix_(mid_i, mid_j)]) > tolerance / 2
+    out[np.ix_(mid_i, mid_j)] = mid
+
+    # Evaluate every pixel in the tiles that failed the check. A sharp feature, such as a kink in
+    # the profile, may run on into tiles where it slipped between the check points, so keep
+    # refining the neighbours of any tile whose pixels really missed until none are left
+    done = np.zeros_like(refine)
+    while np.any(refine):
+        done |= refine
+        # Scattered evaluations cost more per pixel, so past a point it is faster to evaluate everything
+        if np.mean(done) > 0.5:
+            return func(np.arange(ny).reshape(-1, 1), np.arange(nx).reshape(1, -1))
+        I, J = np.nonzero(refine[tile_i][:, tile_j])
+        exact = func(I, J)
+        missed = np.zeros_like(refine)
+        np.logical_or.at(missed, (tile_i[I], tile_j[J]), np.abs(exact - out[I, J]) > tolerance / 2)
+        out[I, J] = exact
+        grown = missed.copy()
+        grown[1:] |= missed[:-1]
+        grown[:-1] |= missed[1:]
+        refine = grown.copy()
+        refine[:, 1:] |= grown[:, :-1]
+        refine[:, :-1] |= grown[:, 1:]
+        refine &= ~done
+    return out
+
+def importance_cdf(weights, uniform = 0.5):
+    """
+    Cumulative probability for drawing each element with importance_sample. The probability is
+    proportional to weights, mixed with a uniform fraction so that every element can be drawn.
+
+    weights: importance of each element, for example the model flux in each pixel
+    uniform: fraction of the probability spread evenly over all elements
+    """
+    weights = np.abs(np.ravel(weights))
+    total = np.sum(weights)
+    if not (total > 0 and np.isfinite(total)):
+        return np.arange(1, len(weights) + 1) / len(weights)
+    cdf = np.cumsum(uniform / len(weights) + (1 - uniform) * weights / total)
+    return cdf / cdf[-1]
+
+def importance_sample(cdf, size):
+    """
+    Draw "size" indices (with replacement) from the distribution given by importance_cdf. Also
+    returns the factor for each draw which makes the average of factor times the drawn values an
+    unbiased estimate of the mean over all elements. Each draw is a binary search, so the CDF can
+    be built once and reused for many samples.
+    """
+    index = np.minimum(np.searchsorted(cdf, np.random.uniform(size = size), side = "right"), len(cdf) - 1)
+    p = cdf[index] - np.where(index > 0, cdf[index - 1], 0.)
+    return index, 1 / (len(cdf) * p)
@@ -0,0 +1,279 @@
+import unittest
+from autoprof.image import AP_Image, PSF_Image
+from autoprof.models import FlatSky, Sersic_Galaxy, NonParametric_Galaxy
+import numpy as np
+
+class TestModel(unittest.TestCase):
+    def test_model_updates(self):
+
+        target = AP_Image(np.ones((20,20)), pixelscale = 1.0)
+        sky = FlatSky("sky", target, parameters = {"sky": {"value": 1.}, "noise": {"value": 0.1}})
+        sky.initialize()
+
+        self.assertTrue(sky.check_updates(), "new model should need to be rendered")
+        sky.sample_model()
+        self.assertFalse(sky.check_updates(), "model should not need rendering if nothing has changed")
+
+        sky["noise"].set_value(0.2)
+        self.assertFalse(sky.check_updates(), "noise does not affect the sky model image")
+        self.assertTrue(sky.is_sampled, "noise does not affect the sky model image")
+        
+        sky["sky"].set_value(2.)
+        self.assertTrue(sky.check_updates(), "sky level affects the model image")
+        self.assertTrue(sky.is_sampled, "sky level only rescales the model image")
+        self.assertFalse(sky.is_scaled, "sky level affects the model image")
+        sky.rescale_amplitude()
+        self.assertTrue(np.allclose(sky.model_image.data, 2.), "rescaled sky should match the new sky level")
+
+        sky["sky"].set_value(0.)
+        sky.check_updates()
+        sky.rescale_amplitude()
+        sky["sky"].set_value(3.)
+        self.assertTrue(sky.check_updates(), "sky level affects the model image")
+        self.assertFalse(sky.is_sampled, "a zero amplitude image can't be rescaled")
+
+    def test_geometry_cache(self):
+
+        target = AP_Image(np.zeros((30,40)), pixelscale = 1.0)
+        model = Sersic_Galaxy("sersic", target, parameters = {
+            "center": {"value": [20.3, 14.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 5.}, "I0": {"value": 10.},
+        })
+
+        self.assertIs(model["center:1"], model["center"][1], "array elements should be accessible by name")
+
+        def render():
+            model.check_updates()
+            if not model.is_sampled:
+                model.sample_model()
+            model.rescale_amplitude()
+
+        render()
+        model["n"].set_value(3.)
+        render()
+        R = model.geometry_map("R", model.model_image, model.geometry_parameters, lambda: None)
+        self.assertIsNotNone(R, "radius map should be cached once the same geometry is sampled twice")
+
+        model["I0"].set_value(20.)
+        model.check_updates()
+        self.assertTrue(model.is_sampled, "amplitude changes should not resample the model")
+        model.rescale_amplitude()
+        cached = np.copy(model.model_image.data)
+        model.sample_model()
+        self.assertTrue(np.allclose(model.model_image.data, cached), "rescaled image should match the sampled image")
+        self.assertIs(model.geometry_map("R", model.model_image, model.geometry_parameters, lambda: None), R, "profile changes should reuse the radius map")
+
+        model["q"].set_value(0.5)
+        render()
+        self.assertIsNone(model.geometry_map("R", model.model_image, model.geometry_parameters, lambda: None, lazy = True), "geometry changes should invalidate the radius map")
+        model["q"].set_value(0.6)
+        model["n"].set_value(2.)
+        render()
+        model["n"].set_value(3.)
+        render()
+        self.assertIsNotNone(model.geometry_map("R", model.model_image, model.geometry_parameters, lambda: None, lazy = True), "radius map should be rebuilt for the new geometry")
+        self.assertTrue(np.allclose(model.model_image.data, cached), "cached radius map should give the same model image")
+
+    def test_sample_pixels(self):
+
+        target = AP_Image(np.zeros((30,40)), pixelscale = 1.0)
+        model = Sersic_Galaxy("sersic", target, parameters = {
+            "center": {"value": [20.3, 14.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 5.}, "I0": {"value": 10.},
+        })
+        sky = FlatSky("sky", target, parameters = {"sky": {"value": 1.}, "noise": {"value": 0.1}})
+        model.sample_model()
+        I = np.array([0, 14, 15, 29])
+        J = np.array([0, 20, 21, 39])
+        self.assertTrue(np.allclose(model.sample_pixels(I, J, target), model.model_image.data[I, J]), "pixel samples should match the rendered image")
+        self.assertTrue(np.all(sky.sample_pixels(I, J, target) == sky.model_offset()), "constant models should sample their offset")
+        model.psf_mode = "direct"
+        self.assertIsNone(model.sample_pixels(I, J, target), "PSF convolved models can't be sampled by pixel")
+
+    def test_radial_loss(self):
+
+        target = AP_Image(np.zeros((30,40)), pixelscale = 1.0)
+        model = Sersic_Galaxy("sersic", target, parameters = {
+            "center": {"value": [20.3, 14.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 5.}, "I0": {"value": 10.},
+        })
+        loss_image = AP_Image(np.random.normal(size = (30,40))**2, pixelscale = 1.0)
+        rad_bins = np.array([0., 1.5, 3., 6., 12., 1000.])
+
+        # Per bin means should match a direct binning of the transformed radius
+        X, Y = loss_image.get_coordinate_meshgrid(model["center"][0].value, model["center"][1].value)
+        R = model.radius_metric(*model.transform_coordinates(X, Y))
+        expected = np.array(list(np.mean(loss_image.data[(R >= rad_bins[i]) & (R < rad_bins[i+1])]) for i in range(len(rad_bins) - 1)))
+        self.assertTrue(np.allclose(model.radial_loss(loss_image, rad_bins), expected), "bincount radial loss should match the binned means")
+
+        # Small geometry changes reuse the bin map, larger ones rebuild it
+        key = ("radial bins 1 6", loss_image.data.shape, tuple(loss_image.origin), loss_image.pixelscale)
+        bin_map = model._geometry_cache[key][1]
+        model["center"].set_value([20.32, 14.6])
+        model.radial_loss(loss_image, rad_bins)
+        self.assertIs(model._geometry_cache[key][1], bin_map, "bin map should be reused within the tolerance")
+        model["PA"].set_value(1.)
+        model.radial_loss(loss_image, rad_bins)
+        self.assertIsNot(model._geometry_cache[key][1], bin_map, "bin map should be rebuilt beyond the tolerance")
+
+    def test_center_shift(self):
+
+        target = AP_Image(np.zeros((60,60)), pixelscale = 1.0)
+        XX, YY = np.meshgrid(np.arange(15) - 7, np.arange(15) - 7)
+        psf = PSF_Image(np.exp(-0.5 * (XX**2 + YY**2) / 2.**2), pixelscale = 1.0, fwhm = 2. * 2.355)
+        def make(center, Rs = 6.):
+            model = Sersic_Galaxy("sersic", target, psf_mode = "fft", parameters = {
+                "center": {"value": center}, "q": {"value": 0.8}, "PA": {"value": 40.},
+                "n": {"value": 0.5}, "Rs": {"value": Rs}, "I0": {"value": 10.},
+            })
+            model.noise_level = 0.01
+            return model
+        model = make([30.2, 29.6])
+        model.check_updates()
+        model.sample_model()
+        model.convolve_psf(psf)
+        model.shift_center()
+        model.rescale_amplitude()
+
+        model["center"].set_value([30.5, 29.4])
+        model["I0"].set_value(12.)
+        model.check_updates()
+        self.assertTrue(model.is_sampled, "small center shifts should not resample the model")
+        model.shift_center()
+        model.rescale_amplitude()
+        shifted = make([30.5, 29.4])
+        shifted["I0"].set_value(12.)
+        shifted.sample_model()
+        shifted.convolve_psf(psf)
+        self.assertTrue(np.allclose(model.model_image.data, shifted.model_image.data, atol = 1e-6), "shifted image should match the image rendered at the new center")
+
+        model["center"].set_value([31.5, 29.4])
+        model.check_updates()
+        self.assertFalse(model.is_sampled, "large center shifts should resample the model")
+
+        # A galaxy which fills its window has flux on the edge, so it must be rendered again
+        model = make([30.2, 29.6], Rs = 25.)
+        model.check_updates()
+        model.sample_model()
+        model.convolve_psf(psf)
+        model["center"].set_value([30.5, 29.4])
+        model.check_updates()
+        self.assertFalse(model.is_sampled, "models with flux on the window edge should not be shifted")
+        model.sample_model()
+        model.convolve_psf(psf)
+        model.shift_center()
+        direct = make([30.5, 29.4], Rs = 25.)
+        direct.sample_model()
+        direct.convolve_psf(psf)
+        self.assertTrue(np.allclose(model.model_image.data, direct.model_image.data), "the image should match a direct render at the new center")
+
+        # Without a PSF the image is not band limited, so it must be rendered again
+        model = Sersic_Galaxy("sersic", AP_Image(np.zeros((80,80)), pixelscale = 1.0), psf_mode = "fft", parameters = {
+            "center": {"value": [40.2, 39.6]}, "q": {"value": 0.8}, "PA": {"value": 40.},
+            "n": {"value": 4.}, "Rs": {"value": 6.}, "I0": {"value": 10.},
+        })
+        model.check_updates()
+        model.sample_model()
+        model.convolve_psf()
+        model["center"].set_value([40.5, 39.4])
+        model.check_updates()
+        self.assertFalse(model.is_sampled, "unconvolved models should not be shifted")
+
+    def test_window_sizing(self):
+
+        target = AP_Image(np.zeros((200,200)), pixelscale = 0.5)
+        model = Sersic_Galaxy("sersic", target, parameters = {
+            "center": {"value": [60.2, 80.6]}, "q": {"value": 0.7}, "PA": {"value": 30.},
+            "n": {"value": 1.}, "Rs": {"value": 5.}, "I0": {"value": 5.},
+        })
+        radius = model.window_radius(0.01)
+        self.assertAlmostEqual(model.radial_model(np.array([radius]), target)[0], 0.01, delta = 0.001, msg = "window radius should be where the profile reaches the level")
+
+        model.center_window(radius)
+        model.sample_model()
+        edges = np.concatenate((model.model_image.data[0], model.model_image.data[-1], model.model_image.data[:,0], model.model_image.data[:,-1]))
+        self.assertLess(np.max(edges), 0.01, "model should be below the level at the window edge")
+        self.assertLess(model.model_image.data.size, 200*200, "window should shrink to the model extent")
+
+    def test_parameter_derivatives(self):
+
+        target = AP_Image(np.zeros((30,40)), pixelscale = 0.5)
+        models = [
+            Sersic_Galaxy("sersic", target, parameters = {
+                "center": {"value": [20.3, 14.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+                "n": {"value": 2.}, "Rs": {"value": 3.}, "I0": {"value": 10.},
+            }),
+            NonParametric_Galaxy("nonparametric", target, parameters = {
+                "center": {"value": [20.3, 14.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+                "I(R)": {"value": 10*np.exp(-np.arange(12)/3)},
+            }, profR = np.linspace(0, 11, 12)),
+            FlatSky("sky", target, parameters = {"sky": {"value": 1.}, "noise": {"value": 0.1}}),
+        ]
+        for model in models:
+            derivatives = model.parameter_derivatives()
+            self.assertGreater(len(derivatives), 0, "built in models should have analytic derivatives")
+            for name in derivatives:
+                # Compare with a central finite difference
+                value = model[name].value
+                step = 1e-5 * max(1., abs(value))
+                images = []
+                for delta in (step, -step):
+                    model[name].set_value(value + delta)
+                    model.sample_model()
+                    images.append(np.copy(model.model_image.data))
+                model[name].set_value(value)
+                numerical = (images[0] - images[1]) / (2 * step)
+                self.assertTrue(np.allclose(derivatives[name].data, numerical, rtol = 1e-3, atol = 1e-5 * np.max(np.abs(numerical))), f"analytic derivative should match finite difference for {model.name} {name}")
+
+    def test_profile_lookup(self):
+
+        target = AP_Image(np.zeros((120,120)), pixelscale = 1.0)
+        model = Sersic_Galaxy("sersic", target, parameters = {
+            "center": {"value": [60.2, 59.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 4.}, "Rs": {"value": 3.}, "I0": {"value": 10.},
+        })
+        model.profile_lookup = True
+        profile = model.radial_profile(model.model_image, 50.)
+        R = np.linspace(0., 200., 1000)
+        self.assertTrue(np.allclose(profile(R), model.radial_model(R, model.model_image), rtol = 1e-3), "the lookup should match the profile, including beyond the table")
+        model.sample_model()
+        lookup = np.copy(model.model_image.data)
+        model.profile_lookup = False
+        model.sample_model()
+        self.assertTrue(np.allclose(lookup, model.model_image.data, rtol = 1e-3), "the lookup should cover every pixel of the image")
+
+    def test_jacobian(self):
+
+        target = AP_Image(np.zeros((30,40)), pixelscale = 0.5)
+        model = Sersic_Galaxy("sersic", target, parameters = {
+            "center": {"value": [20.3, 14.6]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 3.}, "I0": {"value": 10.},
+        })
+        indices = np.arange(len(model.parameter_vector))
+        values = model.parameter_vector.get_values()
+        model.sample_model()
+        model.check_updates()
+        versions = np.copy(model.parameter_vector.versions)
+        analytic = model.jacobian(indices)
+        # Without analytic derivatives every element falls back to finite differences
+        model.derivative_images = lambda sample_image, names: {}
+        numerical = model.jacobian(indices, step = 1e-5)
+        self.assertTrue(np.allclose(analytic, numerical, rtol = 1e-3, atol = 1e-5 * np.max(np.abs(numerical))), "analytic jacobian should match finite differences in the representation")
+        self.assertTrue(np.all(model.parameter_vector.get_values() == values), "finite differences should restore the parameters")
+        self.assertTrue(np.all(model.parameter_vector.versions == versions), "finite differences should restore the parameter versions")
+        self.assertFalse(model.check_updates(), "the jacobian should not flag the model to be rendered again")
+
+        # With a PSF the derivatives are convolved like the model image, over the PSF window only
+        X, Y = np.meshgrid(np.arange(9) - 4., np.arange(9) - 4.)
+        psf = PSF_Image(np.exp(-(X**2 + Y**2) / 4), pixelscale = 0.5, fwhm = 1.2)
+        model.psf_mode = "fft"
+        model.psf_window_size = 10
+        convolved = model.jacobian(indices[2:4], step = 1e-5, psf = psf)
+        for J, expected in zip(convolved, numerical[2:4]):
+            image = model.model_image.blank_copy()
+            image.data[:] = expected
+            model.convolve_image(image, psf)
+            self.assertTrue(np.allclose(J, image.data), "the jacobian should be convolved like the model image")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
 from autoprof.models import Parameter
+from autoprof.models.parameter_object import Parameter_Array, Parameter_Vector, Optimize_History
+from types import SimpleNamespace
 import numpy as np
+import tempfile
+import os
 
 class TestParameter(unittest.TestCase):
     def test_parameter_setting(self):
@@ -16,6 +20,20 @@ class TestParameter(unittest.TestCase):
         fixed_param.set_value(2)
         self.assertEqual(fixed_param.value, 1, msg = "Fixed value should be set to 1")
 
+    def test_parameter_version(self):
+
+        base_param = Parameter('base param', value = 1.)
+        start_version = base_param.version
+        base_param.set_value(1.)
+        self.assertEqual(base_param.version, start_version, msg = "Setting the same value should not change the version")
+        base_param.set_value(2.)
+        self.assertGreater(base_param.version, start_version, msg = "Changing the value should change the version")
+
+        array_param = Parameter_Array('array param', value = [1., 2., 3.])
+        start_version = array_param.version
+        array_param[1].set_value(5.)
+        self.assertGreater(array_param.version, start_version, msg = "Changing an element should change the array version")
+        
     def test_parameter_limits(self):
         
         # Lower limit parameter
@@ -98,6 +116,82 @@ class TestParameter(unittest.TestCase):
         param_array2 = np.array(list(Parameter(f'base param{i}', value = float(i)) for i in range(5)), dtype = Parameter)
 
         self.assertTrue(np.all((param_array1 - param_array2) == 3), msg = "parameter array difference not as expected")
+
+
+    def test_parameter_vector(self):
+
+        vector = Parameter_Vector()
+        params = [
+            Parameter('free', vector = vector, value = 2.),
+            Parameter('lower', vector = vector, value = 2., limits = (1, None)),
+            Parameter('upper', vector = vector, value = 0., limits = (None, 1)),
+            Parameter('range', vector = vector, value = 0.5, limits = (0, 1)),
+            Parameter('cyclic', vector = vector, value = 0.5, limits = (0, 1), cyclic = True),
+        ]
+        array_param = Parameter_Array('array', vector = vector, value = [1., 2., 3.], limits = (0, None))
+        self.assertEqual(len(vector), 8, msg = "vector should hold every parameter and array element")
+        self.assertEqual(array_param[1]._index, vector.index('array:1'), msg = "array elements should be views onto the vector")
+
+        # Vectorized transforms should match setting the parameters one at a time
+        representation = np.linspace(-3, 3, len(vector))
+        vector.set_representation(representation)
+        for P, rep in zip(params + list(array_param), representation):
+            single = Parameter('single', limits = P.limits, cyclic = P.cyclic)
+            single.set_representation(rep)
+            self.assertAlmostEqual(P.value, single.value, msg = f"vectorized representation should match for {P.name}")
+        self.assertTrue(np.allclose(array_param.get_values(), vector.get_values(vector.index(['array:0', 'array:1', 'array:2']))), msg = "array values should read from the vector")
+
+        # Fixed parameters are skipped unless overridden
+        fixed = Parameter('fixed', vector = vector, value = 1., fixed = True)
+        vector.set_values([5., 5.], vector.index(['free', 'fixed']))
+        self.assertEqual(params[0].value, 5., msg = "free parameters should be updated by the vector")
+        self.assertEqual(fixed.value, 1., msg = "fixed parameters should not be updated by the vector")
+
+    def test_optimize_history(self):
+
+        vector = Parameter_Vector()
+        parameters = {
+            "center": Parameter_Array("center", vector = vector, value = [0., 0.]),
+            "I0": Parameter("I0", vector = vector, value = 1.),
+            "PA(R)": Parameter_Array("PA(R)", vector = vector, value = [0., 0., 0.]),
+        }
+        model = SimpleNamespace(
+            name = "test",
+            parameters = parameters,
+            parameter_vector = vector,
+            parameter_qualities = {"center": {}, "I0": {}, "PA(R)": {"loss": "radial"}},
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            history = Optimize_History(model, depth = 4, memmap = os.path.join(tmpdir, "history.dat"))
+            for i in range(6):
+                parameters["I0"].set_value(float(i))
+                history.add_step(parameters, {"global": float(i), "radial": np.arange(3) + i})
+            self.assertEqual(len(history), 4, msg = "ring buffer should hold at most depth steps")
+            self.assertEqual(history.get_loss(), 5., msg = "most recent loss should come first")
+
+            loss_history = history.get_loss_history(limit = 3)
+            loss, indices, reps = loss_history["global"]
+            self.assertTrue(np.all(loss == [5., 4., 3.]), msg = "loss history should run most recent first")
+            self.assertEqual(set(indices), set(vector.index(["center:0", "center:1", "I0"])), msg = "global loss should hold the global parameters")
+            self.assertTrue(np.all(reps[:, list(indices).index(vector.index("I0"))] == [5., 4., 3.]), msg = "representations should follow the loss")
+            self.assertEqual(list(loss_history["radial:1"][1]), [vector.index("PA(R):1")], msg = "vector losses should select one array element")
+            self.assertTrue(np.all(loss_history["radial:1"][0] == [6., 5., 4.]), msg = "vector losses should select one loss element")
+
+            # Fixed parameters are dropped from the history
+            parameters["I0"].update_fixed(True)
+            history.add_step(parameters, {"global": 6., "radial": np.arange(3) + 6})
+            self.assertNotIn(vector.index("I0"), history.get_loss_history()["global"][1], msg = "fixed parameters should be excluded")
+
+            # Steps pushed out of the ring buffer are spilled to disk
+            self.assertTrue(np.all(history.loss_series() == np.arange(7)), msg = "loss series should include spilled steps")
+            self.assertTrue(np.all(history.spilled_history()[:, 1 + vector.index("I0")] == [0., 1., 2.]), msg = "spilled steps should hold the representations")
+
+            # After a rebaseline only the new steps are compared
+            history.rebaseline()
+            self.assertEqual(len(history.get_loss_history()), 0, msg = "rebaselined history should have no comparable steps")
+            history.add_step(parameters, {"global": 7., "radial": np.arange(3) + 7})
+            self.assertTrue(np.all(history.get_loss_history()["global"][0] == [7.]), msg = "only steps after the rebaseline should be compared")
+            self.assertTrue(np.all(history.loss_series() == np.arange(8)), msg = "loss series should keep the steps before the rebaseline")
         
 if __name__ == "__main__":
     unittest.main()
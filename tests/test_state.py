@@ -1,5 +1,9 @@
 import unittest
 from autoprof.state import State
+from autoprof.image import AP_Image, AP_Window, PSF_Image
+from autoprof.models import FlatSky, Sersic_Galaxy
+from autoprof.nodes import Sample_Models, Loss_Image, Compute_Loss, Global_PSF, Update_Parameters_Random_Grad, Update_Parameters_Linear, Update_Parameters_LM, Update_Parameters_CMAES, Update_Parameters_Adam, Stochastic_Loss
+import numpy as np
 
 
 class TestState(unittest.TestCase):
@@ -25,5 +29,346 @@ class TestState(unittest.TestCase):
             )
 
 
+    def test_model_offsets(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.ones((10,10)), pixelscale = 1.0))
+        sky = FlatSky("sky", new_state.data.target, window = [[0,5],[0,10]], parameters = {"sky": {"value": 0.5}, "noise": {"value": 0.1}})
+        new_state.data.model_image = new_state.data.target.blank_copy()
+        new_state.data.add_model(sky)
+
+        residual = new_state.data.subtract_offsets(new_state.data.target - new_state.data.model_image)
+        self.assertTrue(np.allclose(residual.data[:,:5], 0.5), "offsets should be subtracted inside their window")
+        self.assertTrue(np.allclose(residual.data[:,5:], 1.), "offsets should not change pixels outside their window")
+        self.assertTrue(np.allclose(new_state.data.materialize_model_image().data, 1 - residual.data), "materialized model should include the offsets")
+        self.assertTrue(np.allclose(new_state.data.model_image.data, 0.), "materializing should not change the model image")
+
+    def test_model_update(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.random.normal(size = (30,30)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((30,30)), pixelscale = 1.0)
+        galaxies = list(Sersic_Galaxy(f"sersic {i}", new_state.data.target, window = [[5*i, 5*i + 20], [3*i, 3*i + 20]], parameters = {
+            "center": {"value": [5*i + 10.2, 3*i + 9.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 3.}, "I0": {"value": 10.},
+        }) for i in range(2))
+        sky = FlatSky("sky", new_state.data.target, parameters = {"sky": {"value": 0.5}, "noise": {"value": 0.1}})
+        new_state.models.models = {"sky": sky, "sersic 0": galaxies[0], "sersic 1": galaxies[1]}
+        new_state.models.model_list = ["sky", "sersic 0", "sersic 1"]
+        for node in (Sample_Models(), Loss_Image()):
+            node.action(new_state)
+        new_state.data.loss_image
+
+        # Change one galaxy, only its window should be updated
+        galaxies[1]["Rs"].set_value(4.)
+        new_state.models.iteration = 1
+        Sample_Models().action(new_state)
+        self.assertEqual(len(new_state.data.changed_windows), 1, "changed models should record their window")
+        Loss_Image().action(new_state)
+        incremental = np.copy(new_state.data.loss_image.data)
+        new_state.data.initialize_model_image()
+        for node in (Sample_Models(), Loss_Image()):
+            node.action(new_state)
+        self.assertTrue(np.allclose(incremental, new_state.data.loss_image.data), "incremental updates should match rebuilding the model image")
+        window = galaxies[1].window
+        self.assertAlmostEqual(new_state.data.window_loss(window), np.mean(new_state.data.loss_image[window].data), msg = "window loss should match the mean of the loss image")
+        new_state.data.build_loss_table()
+        self.assertAlmostEqual(new_state.data.window_loss(window), np.mean(new_state.data.loss_image[window].data), msg = "summed area table should give the same window loss")
+
+    def test_window_loss_nan(self):
+        new_state = State()
+        target = np.random.normal(size = (30,30))
+        target[4, 7] = np.nan
+        target[20, 15] = np.inf
+        new_state.data.update_target(AP_Image(target, pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((30,30)), pixelscale = 1.0)
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = {
+            "center": {"value": [15.2, 14.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 3.}, "I0": {"value": 10.},
+        })
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+        for node in (Sample_Models(), Loss_Image()):
+            node.action(new_state)
+        window = AP_Window(origin = [0., 0.], shape = [25., 30.])
+        direct = new_state.data.window_loss(window)
+        self.assertTrue(np.isfinite(direct), "non-finite pixels should be left out of the window loss")
+        new_state.data.build_loss_table()
+        self.assertAlmostEqual(new_state.data.window_loss(window), direct, msg = "the summed area table should give the same window loss")
+
+    def test_global_psf(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.zeros((30,30)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((30,30)), pixelscale = 1.0)
+        X, Y = np.meshgrid(np.arange(9) - 4., np.arange(9) - 4.)
+        new_state.data.update_psf(PSF_Image(np.exp(-(X**2 + Y**2) / 4), pixelscale = 1.0, fwhm = 2.35))
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = {
+            "center": {"value": [15.2, 14.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 3.}, "I0": {"value": 10.},
+        })
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+        for node in (Sample_Models(), Global_PSF()):
+            node.action(new_state)
+        self.assertFalse(new_state.data.can_update_model_image([]), "a convolved composite should not be updated in place")
+
+        # The next render should start from a fresh composite rather than the convolved one
+        galaxy["Rs"].set_value(4.)
+        new_state.models.iteration = 1
+        for node in (Sample_Models(), Global_PSF()):
+            node.action(new_state)
+        rendered = np.copy(new_state.data.model_image.data)
+        new_state.data.initialize_model_image()
+        new_state.data.add_model(galaxy)
+        Global_PSF().action(new_state)
+        self.assertTrue(np.allclose(rendered, new_state.data.model_image.data), "the composite should only be convolved once")
+
+    def test_screen_proposals(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.zeros((40,40)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((40,40))*0.01, pixelscale = 1.0)
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = {
+            "center": {"value": [20.2, 19.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 4.}, "I0": {"value": 10.},
+        })
+        galaxy.sample_model()
+        new_state.data.target.data[:] = galaxy.model_image.data + np.random.normal(scale = 0.1, size = (40,40))
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+        for node in (Sample_Models(), Loss_Image()):
+            node.action(new_state)
+
+        vector = galaxy.parameter_vector
+        indices = vector.index(["Rs"])
+        current = vector.get_representation(indices)
+        bad = vector.to_representation(np.array([8.]), indices)
+        good = vector.to_representation(np.array([4.05]), indices)
+        chosen = Update_Parameters_Random_Grad().screen_proposals(new_state, galaxy, indices, current, [bad, good])
+        self.assertTrue(np.allclose(chosen, good), "screening should reject a clearly worse proposal")
+        chosen = Update_Parameters_Random_Grad().screen_proposals(new_state, galaxy, indices, current, [bad, bad])
+        self.assertTrue(np.allclose(chosen, bad), "screening should fall back to the best candidate")
+
+    def test_linear(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.zeros((40,40)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((40,40))*0.01, pixelscale = 1.0)
+        parameters = {
+            "center": {"value": [20.2, 19.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 4.}, "I0": {"value": 10.},
+        }
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        galaxy.sample_model()
+        new_state.data.target.data[:] = galaxy.model_image.data + 1. + np.random.normal(scale = 0.1, size = (40,40))
+        parameters.update({"I0": {"value": 3.}})
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        sky = FlatSky("sky", new_state.data.target, parameters = {"sky": {"value": 0.2}, "noise": {"value": 0.1}})
+        for model in (galaxy, sky):
+            model.parameter_vector.set_uncertainty(0.01)
+        new_state.models.models = {"sky": sky, "sersic": galaxy}
+        new_state.models.model_list = ["sky", "sersic"]
+
+        nodes = (Update_Parameters_Random_Grad(), Sample_Models(), Update_Parameters_Linear(), Loss_Image(), Compute_Loss())
+        for node in nodes[1:]:
+            node.action(new_state)
+        self.assertAlmostEqual(galaxy["I0"].value, 10., delta = 0.25, msg = "the linear solve should recover the galaxy amplitude")
+        self.assertAlmostEqual(sky["sky"].value, 1., delta = 0.03, msg = "the linear solve should recover the sky level")
+        self.assertFalse(galaxy["I0"].fixed, "the linear solve should not fix the amplitude")
+
+        # The stochastic updates leave the solved amplitudes to the linear solve
+        for i in range(5):
+            amplitudes = (galaxy["I0"].value, sky["sky"].value)
+            nodes[0].action(new_state)
+            self.assertEqual((galaxy["I0"].value, sky["sky"].value), amplitudes, "random updates should not change the solved amplitudes")
+            for node in nodes[1:]:
+                node.action(new_state)
+        self.assertNotEqual(galaxy["Rs"].value, 4., "random updates should still move the other parameters")
+
+    def test_stochastic_loss(self):
+        new_state = State(ap_stochastic_loss_pixels = 200, ap_stochastic_loss_patience = 1000)
+        new_state.data.update_target(AP_Image(np.zeros((60,60)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((60,60))*0.01, pixelscale = 1.0)
+        parameters = {
+            "center": {"value": [30.2, 29.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 5.}, "I0": {"value": 10.},
+        }
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        galaxy.sample_model()
+        new_state.data.target.data[:] = galaxy.model_image.data + np.random.normal(scale = 0.1, size = (60,60))
+        parameters.update({"Rs": {"value": 5.5}})
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+        for node in (Sample_Models(), Loss_Image(), Compute_Loss()):
+            node.action(new_state)
+        full = galaxy.loss["global"]
+
+        # Record the number of pixels each estimate evaluates the model at
+        sample_pixels = galaxy.sample_pixels
+        sizes = []
+        def counted(I, J, image, proxy = False):
+            sizes.append(len(I))
+            return sample_pixels(I, J, image, proxy)
+        galaxy.sample_pixels = counted
+
+        node = Stochastic_Loss()
+        estimates = []
+        for i in range(200):
+            node.action(new_state)
+            estimates.append(galaxy.loss["global"])
+        self.assertAlmostEqual(np.mean(estimates), full, delta = 4 * np.std(estimates) / np.sqrt(len(estimates)), msg = "stochastic estimates should average to the full loss")
+        self.assertEqual(set(sizes), {200}, "the sample should keep its initial size until the loss stops improving")
+
+        # The sample only doubles once the estimates stop improving by more than their noise
+        sample = {"N": 200, "best": np.inf, "stale": 0}
+        for loss in (10., 9., 8., 7.):
+            node.update_sample(sample, loss, 0.1, 2., 3)
+        self.assertEqual(sample["N"], 200, "the sample should not grow while the loss is improving")
+        for loss in (6.9, 7.05, 6.95):
+            node.update_sample(sample, loss, 0.1, 2., 3)
+        self.assertEqual(sample["N"], 400, "the sample should double once the loss stops improving")
+
+        # With the parameters held fixed the sample grows until the full loss is used
+        new_state.options.options["ap_stochastic_loss_patience"] = 3
+        node = Stochastic_Loss()
+        sizes.clear()
+        for i in range(100):
+            galaxy.loss = None
+            count = len(sizes)
+            node.action(new_state)
+            if len(sizes) == count:
+                break
+        self.assertEqual(sizes, sorted(sizes), "the sample should never shrink")
+        self.assertGreater(sizes[-1], 200, "the sample should grow once the loss stops improving")
+        self.assertLess(i, 99, "a large enough sample should fall back to the full loss")
+        self.assertAlmostEqual(galaxy.loss["global"], full, msg = "the fallback should compute the full loss")
+
+        # Models which can't be evaluated pixel by pixel fall back to the full loss
+        galaxy.psf_mode = "fft"
+        galaxy.loss = None
+        Stochastic_Loss().action(new_state)
+        self.assertAlmostEqual(galaxy.loss["global"], full, msg = "convolved models should fall back to the full loss")
+
+    def test_lm(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.zeros((40,40)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((40,40))*0.01, pixelscale = 1.0)
+        parameters = {
+            "center": {"value": [20.2, 19.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 4.}, "I0": {"value": 10.},
+        }
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        galaxy.sample_model()
+        new_state.data.target.data[:] = galaxy.model_image.data + np.random.normal(scale = 0.1, size = (40,40))
+        parameters.update({"center": {"value": [20.5, 19.4]}, "q": {"value": 0.7}, "n": {"value": 2.5}, "Rs": {"value": 3.}})
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+
+        nodes = (Update_Parameters_LM(), Sample_Models(), Loss_Image(), Compute_Loss())
+        for i in range(10):
+            for node in nodes:
+                node.action(new_state)
+        self.assertLess(galaxy.loss["global"], 1.1, "LM should converge to the noise level in a few iterations")
+        self.assertAlmostEqual(galaxy["Rs"].value, 4., delta = 0.3, msg = "LM should recover the scale length")
+
+    def test_lm_joint(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.zeros((40,60)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((40,60))*0.01, pixelscale = 1.0)
+        def make(i, Rs):
+            return Sersic_Galaxy(f"sersic {i}", new_state.data.target, window = [[30*i, 30*i + 28], [0, 40]], parameters = {
+                "center": {"value": [30*i + 14.2, 19.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+                "n": {"value": 1.5}, "Rs": {"value": Rs}, "I0": {"value": 10.},
+            })
+        truth = list(make(i, 3.) for i in range(2))
+        sky = FlatSky("sky", new_state.data.target, parameters = {"sky": {"value": 1.}, "noise": {"value": 0.1}})
+        for galaxy in truth:
+            galaxy.sample_model()
+            new_state.data.target += galaxy.model_image
+        new_state.data.target.data += 1. + np.random.normal(scale = 0.1, size = (40,60))
+        galaxies = list(make(i, 4.) for i in range(2))
+        new_state.models.models = {"sky": sky, "sersic 0": galaxies[0], "sersic 1": galaxies[1]}
+        new_state.models.model_list = ["sky", "sersic 0", "sersic 1"]
+        sky["sky"].set_value(0.8)
+        sky["noise"].update_fixed(True)
+
+        nodes = (Update_Parameters_LM(), Sample_Models(), Loss_Image(), Compute_Loss())
+        for node in nodes[1:]:
+            node.action(new_state)
+        group = list((model, np.nonzero(~model.parameter_vector.fixed)[0]) for model in (sky, galaxies[0], galaxies[1]))
+        A, b = nodes[0].normal_equations(new_state, group)
+        self.assertEqual(A.shape, (15, 15), "normal equations should cover every free parameter")
+        self.assertLess(A.nnz, 15**2, "models which don't overlap should not be coupled")
+        for i in range(10):
+            for node in nodes:
+                node.action(new_state)
+        self.assertLess(new_state.data.window_loss(new_state.data.model_image.window), 1.1, "joint LM should converge to the noise level")
+        self.assertAlmostEqual(sky["sky"].value, 1., delta = 0.02, msg = "joint LM should separate the sky from the galaxies")
+
+    def test_cmaes(self):
+        new_state = State(ap_cmaes_threads = 2)
+        new_state.data.update_target(AP_Image(np.zeros((40,40)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((40,40))*0.01, pixelscale = 1.0)
+        parameters = {
+            "center": {"value": [20.2, 19.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 4.}, "I0": {"value": 10.},
+        }
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        galaxy.sample_model()
+        new_state.data.target.data[:] = galaxy.model_image.data + np.random.normal(scale = 0.1, size = (40,40))
+        parameters.update({"q": {"value": 0.7}, "n": {"value": 2.5}, "Rs": {"value": 3.5}})
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        galaxy.parameter_vector.set_uncertainty(0.1)
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+
+        nodes = (Update_Parameters_CMAES(), Sample_Models(), Loss_Image(), Compute_Loss())
+        for i in range(100):
+            for node in nodes:
+                node.action(new_state)
+        self.assertLess(galaxy.loss["global"], 1.1, "CMA-ES should converge to the noise level")
+        self.assertEqual(len(nodes[0].workers["sersic"]), 2, "each thread should render with its own model copy")
+
+        # Proposals are scored with the PSF applied like the rendered model, which is left untouched
+        X, Y = np.meshgrid(np.arange(9) - 4., np.arange(9) - 4.)
+        new_state.data.update_psf(PSF_Image(np.exp(-(X**2 + Y**2) / 4), pixelscale = 1.0, fwhm = 2.35))
+        galaxy.psf_mode = "fft"
+        # Only part of the image is convolved, as for windows larger than the PSF window
+        galaxy.psf_window_size = 16
+        galaxy["n"].set_value(galaxy["n"].value + 1e-3)
+        for node in nodes[1:]:
+            node.action(new_state)
+        versions = np.copy(galaxy.parameter_vector.versions)
+        indices = np.nonzero(~galaxy.parameter_vector.fixed)[0]
+        current = galaxy.parameter_vector.get_representation(indices)
+        losses = Update_Parameters_CMAES().score(new_state, galaxy, indices, np.array([current, current]))
+        self.assertTrue(np.allclose(losses, galaxy.loss["global"], rtol = 1e-6), "the current parameters should score the loss of the rendered model")
+        self.assertTrue(np.all(galaxy.parameter_vector.versions == versions), "scoring should not change the parameter versions")
+
+    def test_adam(self):
+        new_state = State()
+        new_state.data.update_target(AP_Image(np.zeros((40,40)), pixelscale = 1.0))
+        new_state.data.update_variance(np.ones((40,40))*0.01, pixelscale = 1.0)
+        parameters = {
+            "center": {"value": [20.2, 19.7]}, "q": {"value": 0.6}, "PA": {"value": 40.},
+            "n": {"value": 2.}, "Rs": {"value": 4.}, "I0": {"value": 10.},
+        }
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters)
+        galaxy.sample_model()
+        new_state.data.target.data[:] = galaxy.model_image.data + np.random.normal(scale = 0.1, size = (40,40))
+        parameters.update({"q": {"value": 0.7}, "n": {"value": 2.3}})
+        galaxy = Sersic_Galaxy("sersic", new_state.data.target, parameters = parameters, learning_rate_schedule = lambda iteration: 1. / (1 + iteration / 50))
+        galaxy.parameter_vector.set_uncertainty(0.05)
+        galaxy["PA"].update_fixed(True)
+        new_state.models.models = {"sersic": galaxy}
+        new_state.models.model_list = ["sersic"]
+        PA = galaxy["PA"].value
+
+        nodes = (Update_Parameters_Adam(), Sample_Models(), Loss_Image(), Compute_Loss())
+        for i in range(100):
+            for node in nodes:
+                node.action(new_state)
+        self.assertLess(galaxy.loss["global"], 1.1, "Adam should converge to the noise level")
+        self.assertEqual(galaxy["PA"].value, PA, "fixed parameters should not be updated")
+        self.assertEqual(nodes[0].moments["sersic"]["t"][galaxy.parameter_vector.index("PA")], 0, "fixed parameters should not have moments")
+
 if __name__ == "__main__":
     unittest.main()
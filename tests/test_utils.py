@@ -0,0 +1,120 @@
+import unittest
+from autoprof.utils.interpolate import cubic_spline_coefficients, cubic_spline_evaluate, adaptive_profile_table, profile_table_evaluate
+from autoprof.utils.parametric_profiles import sersic
+from autoprof.utils.sampling import symmetric_sample, coarse_sample, importance_cdf, importance_sample
+from autoprof.utils.conversions.coordinates import Axis_Ratio_Cartesian
+from autoprof.utils.agregate_pixel import segment_median, weighted_square_sum, summed_area_table, window_sum
+from scipy.interpolate import UnivariateSpline
+import numpy as np
+
+class TestInterpolate(unittest.TestCase):
+    def test_cubic_spline(self):
+
+        knots = np.array([0., 1., 2.2, 3.5, 5., 7., 9.4, 12.])
+        values = np.exp(-knots / 3) + 0.1 * np.sin(knots)
+        X = np.linspace(-1, 14, 1000)
+
+        coefs = cubic_spline_coefficients(knots, values)
+        spline = UnivariateSpline(knots, values, ext = "const", s = 0)
+        self.assertTrue(np.allclose(cubic_spline_evaluate(knots, coefs, X), spline(X)), "cubic spline should match FITPACK interpolating spline")
+
+        # Evaluate two profiles together
+        stacked = cubic_spline_coefficients(knots, np.stack((values, 2 * values), axis = -1))
+        res = cubic_spline_evaluate(knots, stacked, X.reshape(20,50))
+        self.assertEqual(res.shape, (20,50,2), "stacked profiles should add a final axis")
+        self.assertTrue(np.allclose(res[...,1], 2 * spline(X).reshape(20,50)), "stacked profiles should evaluate independently")
+
+    def test_profile_table(self):
+
+        R = np.linspace(0.5, 200, 10000)
+        for n in [0.5, 1., 4.]:
+            profile = lambda r: sersic(r, n, 5., 10.)
+            table = adaptive_profile_table(profile, np.min(R), np.max(R), tolerance = 1e-5)
+            self.assertTrue(np.allclose(profile_table_evaluate(table, R), profile(R), rtol = 1e-4, atol = 1e-4), "profile table should reproduce the profile")
+            outside = profile_table_evaluate(table, np.array([250., 1e4]))
+            self.assertTrue(np.allclose(outside, profile_table_evaluate(table, np.array([200.]))), "radii beyond the table should hold its last value")
+
+class TestSampling(unittest.TestCase):
+    def test_symmetric_sample(self):
+
+        for center in [(20., 31.5), (19.5, 26.), (13.3, 40.8), (-3.2, 10.1), (45.7, 25.), (30., 49.5)]:
+            # Profile with a kink where it is clamped to a constant, like a spline beyond its last knot
+            evaluated = []
+            def profile(I, J):
+                evaluated.append(np.broadcast(I, J).size)
+                X, Y = Axis_Ratio_Cartesian(0.6, J - center[1], I - center[0], 0.4)
+                return sersic(np.minimum(np.sqrt(X**2 + Y**2), 12.), 2., 5., 10.)
+            full = profile(np.arange(40).reshape(-1,1), np.arange(50).reshape(1,-1))
+            evaluated.clear()
+            half = symmetric_sample(profile, (40, 50), center)
+            self.assertTrue(np.allclose(half, full, rtol = 1e-12, atol = 0), f"symmetric sampling should reproduce the full evaluation for center {center}")
+            if center in [(20., 31.5), (19.5, 26.)]:
+                self.assertLess(sum(evaluated), 0.75 * full.size, f"grid aligned center {center} should only evaluate part of the pixels")
+
+    def test_coarse_sample(self):
+
+        def profile(I, J):
+            X, Y = Axis_Ratio_Cartesian(0.6, J - 60.3, I - 52.8, 0.4)
+            return sersic(np.sqrt(X**2 + Y**2), 2., 15., 10.)
+        full = profile(np.arange(100).reshape(-1,1), np.arange(130).reshape(1,-1))
+        for tolerance in [1e-3, 1e-2]:
+            coarse = coarse_sample(profile, (100, 130), 8, tolerance)
+            self.assertLess(np.max(np.abs(coarse - full)), tolerance, f"coarse sampling should stay within the tolerance {tolerance}")
+
+        # Spline profile clamped to a constant beyond its last knot, like the nonparametric model
+        knots = np.concatenate(([0.], 1.2**np.arange(24)))
+        coefs = cubic_spline_coefficients(knots, np.log10(sersic(knots, 1.5, 40., 10.)))
+        def kinked(I, J):
+            X, Y = Axis_Ratio_Cartesian(0.7, J - 160.3, I - 148.6, 0.4)
+            return 10**cubic_spline_evaluate(knots, coefs, np.sqrt(X**2 + Y**2))
+        full = kinked(np.arange(300).reshape(-1,1), np.arange(320).reshape(1,-1))
+        for tolerance in [1e-2, 3e-3]:
+            coarse = coarse_sample(kinked, (300, 320), 8, tolerance)
+            self.assertLess(np.max(np.abs(coarse - full)), tolerance, f"coarse sampling should stay within the tolerance {tolerance} across a kink")
+        for shape in [(1, 1), (1, 20), (9, 17)]:
+            self.assertEqual(coarse_sample(profile, shape, 8, 1e-3).shape, shape, "coarse sampling should handle small grids")
+
+    def test_segment_median(self):
+
+        values = np.random.normal(size = 1000)
+        segments = np.random.randint(0, 20, size = 1000)
+        segments[segments == 7] = 8
+        counts = np.bincount(segments, minlength = 21)
+        medians = segment_median(values, segments, counts)
+        expected = np.array(list(np.median(values[segments == i]) if counts[i] > 0 else np.nan for i in range(21)))
+        self.assertTrue(np.allclose(medians, expected, equal_nan = True), "segment medians should match the median of each segment")
+
+    def test_weighted_square_sum(self):
+
+        values = np.random.normal(size = (300, 70))
+        weights = np.random.uniform(size = (300, 70))
+        total, count = weighted_square_sum(values, weights, block = 1000)
+        self.assertAlmostEqual(total, np.sum(weights * values**2), msg = "blocked sum should match the direct sum")
+        self.assertEqual(count, values.size, "every finite element should be counted")
+        self.assertEqual(weighted_square_sum(values[:0], weights[:0]), (0., 0), "empty arrays should sum to zero")
+        values[5, 3] = np.nan
+        weights[200, 10] = np.inf
+        total, count = weighted_square_sum(values, weights, block = 1000)
+        finite = np.isfinite(weights * values**2)
+        self.assertAlmostEqual(total, np.sum((weights * values**2)[finite]), msg = "non-finite elements should be left out of the sum")
+        self.assertEqual(count, values.size - 2, "non-finite elements should not be counted")
+
+    def test_summed_area_table(self):
+
+        image = np.random.normal(size = (40, 30))
+        table = summed_area_table(image)
+        for indices in [(slice(0, 40), slice(0, 30)), (slice(5, 17), slice(3, 4)), (slice(39, 40), slice(10, 30))]:
+            self.assertAlmostEqual(window_sum(table, indices), np.sum(image[indices]), msg = f"window sum should match the direct sum for {indices}")
+
+    def test_importance_sample(self):
+
+        np.random.seed(2)
+        weights = np.exp(-np.linspace(0, 10, 5000))
+        values = weights * 3 + 0.01
+        cdf = importance_cdf(weights, uniform = 0.5)
+        index, factor = importance_sample(cdf, 200000)
+        self.assertAlmostEqual(np.mean(factor * values[index]), np.mean(values), delta = 0.01 * np.mean(values), msg = "importance sampling should give an unbiased mean")
+        self.assertTrue(np.all(np.diff(importance_cdf(np.zeros(10))) > 0), "zero weights should fall back to uniform sampling")
+        
+if __name__ == "__main__":
+    unittest.main()